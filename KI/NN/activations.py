@@ -0,0 +1,197 @@
+# array-native activation functions, shared by nn.neuralNetwork and neuro.neural_network
+# * get_activation resolves a name once into a callable f(x, out=None)
+# * the callable works on whole numpy arrays, out=x computes in place
+# * get_derivative resolves the matching backward kernel for training
+import functools
+from typing import Callable
+
+import numpy
+# for sigmoid
+import scipy.special
+
+try:
+    # optional: evaluates a derivative kernel in one pass instead of several ufunc passes
+    import numexpr
+except ImportError:
+    numexpr = None
+
+ActivationFunction = Callable[..., numpy.ndarray]
+
+
+def _float_dtype(x):
+    # the dtype of a new result: float32 and float64 stay as they are, integers and bools become float64
+    # ! asarray first: result_type reads a plain list as a dtype specification
+    return numpy.result_type(numpy.asarray(x).dtype, numpy.float32)
+
+
+def _linear(x, out=None):
+    if out is None:
+        # ! a copy in the input dtype, dtype=float would turn every float32 array into float64
+        return numpy.array(x, dtype=_float_dtype(x))
+    numpy.copyto(out, x)
+    return out
+
+
+def _binary(x, out=None):
+    # 0 for negative inputs, 1 otherwise
+    if out is None:
+        out = numpy.empty(numpy.shape(x), dtype=_float_dtype(x))
+    return numpy.greater_equal(x, 0, out=out, casting="unsafe")
+
+
+def _arctan(x, out=None):
+    return numpy.arctan(x, out=out)
+
+
+def _relu(x, out=None):
+    return numpy.maximum(x, 0, out=out)
+
+
+def _softplus(x, out=None):
+    # log(1 + e^x), logaddexp does not overflow for large x
+    return numpy.logaddexp(0, x, out=out)
+
+
+def _prelu(parameter: float) -> ActivationFunction:
+    def prelu(x, out=None):
+        out = _linear(x, out)
+        return numpy.multiply(out, parameter, out=out, where=out < 0)
+
+    return prelu
+
+
+def _elu(parameter: float) -> ActivationFunction:
+    def elu(x, out=None):
+        out = _linear(x, out)
+        negative = out < 0
+        numpy.expm1(out, out=out, where=negative)
+        return numpy.multiply(out, parameter, out=out, where=negative)
+
+    return elu
+
+
+ACTIVATIONS = {
+    "linear": _linear,
+    "binary": _binary,
+    "sigmoid": scipy.special.expit,
+    "tanh": numpy.tanh,
+    "arctan": _arctan,
+    "relu": _relu,
+    "softplus": _softplus,
+}
+
+# * these need a parameter, e.g. the slope of the negative part
+PARAMETRIC_ACTIVATIONS = {
+    "prelu": _prelu,
+    "leaky_relu": _prelu,
+    "elu": _elu,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_activation(name: str, parameter: float = 0.0) -> ActivationFunction:
+    name = name.lower()
+    if name in ACTIVATIONS:
+        return ACTIVATIONS[name]
+    if name in PARAMETRIC_ACTIVATIONS:
+        return PARAMETRIC_ACTIVATIONS[name](parameter)
+    raise ValueError(f"Does not support given activation function: {name}")
+
+
+# * fast sigmoid for inference: sigmoid(x) = 0.5 * tanh(0.5 * x) + 0.5
+# * numpy's vectorized tanh makes this ~5x faster than expit for float32 (~2x for float64),
+# * the deviation from expit is only rounding, see sigmoid_error
+# ! a precomputed, interpolated lookup table was measured 2x slower than expit:
+# ! the index gathers and ~8 array passes cost more than the exp they replace
+
+
+def fast_sigmoid(x, out=None):
+    out = numpy.multiply(x, 0.5, out=out)
+    numpy.tanh(out, out=out)
+    numpy.multiply(out, 0.5, out=out)
+    return numpy.add(out, 0.5, out=out)
+
+
+def sigmoid_error(approximation: ActivationFunction, dtype=numpy.float64, limit: float = 40.0, points: int = 1_000_001) -> float:
+    # worst-case deviation from expit (in float64) on a dense grid over [-limit, limit]
+    x = numpy.linspace(-limit, limit, points)
+    return float(numpy.max(numpy.abs(approximation(x.astype(dtype)) - scipy.special.expit(x))))
+
+
+# * derivative kernels: errors *= f'(x), computed from the cached forward output O = f(x)
+# ! the kernels may use outputs as scratch space, O is not needed after the backward step
+
+
+def _sigmoid_derivative(errors, outputs):
+    # f'(x) = O * (1 - O)
+    if numexpr is not None:
+        return numexpr.evaluate("errors * outputs * (1 - outputs)", out=errors)
+    errors *= outputs
+    numpy.subtract(1, outputs, out=outputs)
+    errors *= outputs
+    return errors
+
+
+def _tanh_derivative(errors, outputs):
+    # f'(x) = 1 - O^2
+    if numexpr is not None:
+        return numexpr.evaluate("errors * (1 - outputs * outputs)", out=errors)
+    numpy.square(outputs, out=outputs)
+    numpy.subtract(1, outputs, out=outputs)
+    errors *= outputs
+    return errors
+
+
+def _relu_derivative(errors, outputs):
+    # f'(x) = 1 for O > 0, else 0
+    numpy.copyto(errors, 0, where=outputs <= 0)
+    return errors
+
+
+def _softplus_derivative(errors, outputs):
+    # f'(x) = sigmoid(x) = 1 - e^-O
+    if numexpr is not None:
+        return numexpr.evaluate("-errors * expm1(-outputs)", out=errors)
+    numpy.negative(outputs, out=outputs)
+    numpy.expm1(outputs, out=outputs)
+    errors *= outputs
+    return numpy.negative(errors, out=errors)
+
+
+def _leaky_relu_derivative(parameter: float) -> ActivationFunction:
+    # f'(x) = 1 for O >= 0, else the slope (for a positive slope O < 0 exactly when x < 0)
+    def leaky_relu_derivative(errors, outputs):
+        return numpy.multiply(errors, parameter, out=errors, where=outputs < 0)
+
+    return leaky_relu_derivative
+
+
+DERIVATIVES = {
+    "sigmoid": _sigmoid_derivative,
+    "tanh": _tanh_derivative,
+    "relu": _relu_derivative,
+    "softplus": _softplus_derivative,
+}
+
+PARAMETRIC_DERIVATIVES = {
+    "prelu": _leaky_relu_derivative,
+    "leaky_relu": _leaky_relu_derivative,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_derivative(name: str, parameter: float = 0.0) -> ActivationFunction:
+    name = name.lower()
+    if name in DERIVATIVES:
+        return DERIVATIVES[name]
+    if name in PARAMETRIC_DERIVATIVES:
+        return PARAMETRIC_DERIVATIVES[name](parameter)
+    raise ValueError(f"No derivative for activation function: {name}")
+
+
+if __name__ == "__main__":
+    x = numpy.linspace(-2.0, 2.0, 5)
+    for name in list(ACTIVATIONS) + list(PARAMETRIC_ACTIVATIONS):
+        print(name, get_activation(name, 0.3)(x))
+    for dtype in (numpy.float32, numpy.float64):
+        print(f"fast_sigmoid, {numpy.dtype(dtype)}: worst-case deviation from expit {sigmoid_error(fast_sigmoid, dtype):.2e}")
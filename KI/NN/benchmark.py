@@ -0,0 +1,254 @@
+# reproducible benchmarks for nn.neuralNetwork and neuro.neural_network
+# * synthetic MNIST-shaped data (784 inputs, 10 classes, mostly background pixels), no download needed
+# * every configuration runs in a fresh process, so its peak RSS is its own
+# * results are json, --baseline compares them with a stored run and fails on regressions
+# * timings are the median over the repeats, their spread (max - min) / median is stored next to them
+# ! by default only memory and allocations are gated, timings vary by 20-30% between identical runs on a shared host
+# ! --gate-timings is for a quiet machine and catches large slowdowns only, more repeats narrow the spread
+#
+# python benchmark.py --output results.json
+# python benchmark.py --baseline results.json --tolerance 0.1
+# python benchmark.py --baseline results.json --gate-timings --repeats 9
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy
+import scipy
+
+from mnist_data_set import make_targets, scale_inputs
+from nn import neuralNetwork
+
+# neuro.py lives in KI/, one level up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SEED = 42
+
+
+def synthetic_mnist(records: int, seed: int = SEED):
+    # ~80% background pixels like handwritten digits, the rest 1-255
+    rng = numpy.random.default_rng(seed)
+    pixels = rng.integers(1, 256, size=(records, 784), dtype=numpy.uint8)
+    pixels[rng.random((records, 784)) < 0.8] = 0
+    labels = rng.integers(0, 10, size=records, dtype=numpy.uint8)
+    return labels, pixels
+
+
+def _peak_rss_bytes() -> int:
+    # ! ru_maxrss is in kilobytes on linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _spread(values) -> float:
+    # relative range of the repeats, 0.2 means the slowest and the fastest differ by 20% of the median
+    # ! the full range, not the interquartile one: between runs timings shift by more than the middle repeats show
+    values = numpy.asarray(values, dtype=float)
+    return float((values.max() - values.min()) / numpy.median(values))
+
+
+def _step_allocations(step, steps: int) -> dict:
+    # * tracemalloc sees every numpy buffer: blocks still alive after the steps and the transient peak above the start
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before_size, _ = tracemalloc.get_traced_memory()
+    before = tracemalloc.take_snapshot()
+    for _ in range(steps):
+        step()
+    after_size, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    new_blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+    return {
+        "retained_blocks_per_step": new_blocks / steps,
+        "transient_peak_bytes": max(peak - before_size, 0),
+        "retained_bytes_per_step": max(after_size - before_size, 0) / steps,
+    }
+
+
+def bench_train(hidden_nodes: int, batch_size: int, dtype: str, records: int, repeats: int) -> dict:
+    numpy.random.seed(SEED)
+    labels, pixels = synthetic_mnist(records)
+    inputs = scale_inputs(pixels, dtype=dtype)
+    targets = make_targets(labels, dtype=dtype)
+    n = neuralNetwork(784, hidden_nodes, 10, 0.1, dtype=dtype)
+    # warm up: workspaces, BLAS threads, caches
+    n.train_batch(inputs[: batch_size * 4], targets[: batch_size * 4], batch_size)
+
+    rates = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        n.train_batch(inputs, targets, batch_size)
+        rates.append(records / (time.perf_counter() - start))
+    allocations = _step_allocations(lambda: n.train_batch(inputs[:batch_size], targets[:batch_size], batch_size), 50)
+    return {
+        "benchmark": "train",
+        "hidden_nodes": hidden_nodes,
+        "batch_size": batch_size,
+        "dtype": dtype,
+        "records_per_second": float(numpy.median(rates)),
+        "spread": {"records_per_second": _spread(rates)},
+        "peak_rss_bytes": _peak_rss_bytes(),
+        **allocations,
+    }
+
+
+def bench_query(hidden_nodes: int, batch_size: int, dtype: str, records: int, repeats: int) -> dict:
+    numpy.random.seed(SEED)
+    _, pixels = synthetic_mnist(records)
+    inputs = scale_inputs(pixels, dtype=dtype)
+    n = neuralNetwork(784, hidden_nodes, 10, 0.1, dtype=dtype)
+    n.query_batch(inputs[:batch_size])
+
+    # * percentiles per repeat, the median of each over the repeats
+    per_repeat = {"records_per_second": [], "latency_ms_p50": [], "latency_ms_p90": [], "latency_ms_p99": []}
+    for _ in range(repeats):
+        latencies = []
+        for start in range(0, records, batch_size):
+            began = time.perf_counter()
+            n.query_batch(inputs[start:start + batch_size])
+            latencies.append(time.perf_counter() - began)
+        latencies = numpy.asarray(latencies) * 1e3
+        per_repeat["records_per_second"].append(batch_size / (numpy.median(latencies) / 1e3))
+        for percentile in (50, 90, 99):
+            per_repeat[f"latency_ms_p{percentile}"].append(numpy.percentile(latencies, percentile))
+    allocations = _step_allocations(lambda: n.query_batch(inputs[:batch_size]), 50)
+    return {
+        "benchmark": "query",
+        "hidden_nodes": hidden_nodes,
+        "batch_size": batch_size,
+        "dtype": dtype,
+        **{metric: float(numpy.median(values)) for metric, values in per_repeat.items()},
+        "spread": {metric: _spread(values) for metric, values in per_repeat.items()},
+        "peak_rss_bytes": _peak_rss_bytes(),
+        **allocations,
+    }
+
+
+def bench_neuro(hidden_nodes: int, batch_size: int, dtype: str, records: int, repeats: int) -> dict:
+    from neuro import neural_network
+
+    _, pixels = synthetic_mnist(batch_size)
+    inputs = scale_inputs(pixels, dtype=dtype)
+    rates = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        neural_network(inputs, [hidden_nodes], neuro_output_layer=10, weight_split_method="randomly", activation_function="sigmoid", seed=SEED)
+        rates.append(batch_size / (time.perf_counter() - start))
+    return {
+        "benchmark": "neuro",
+        "hidden_nodes": hidden_nodes,
+        "batch_size": batch_size,
+        "dtype": "float64",  # ! neural_network always computes in float64
+        "records_per_second": float(numpy.median(rates)),
+        "spread": {"records_per_second": _spread(rates)},
+        "peak_rss_bytes": _peak_rss_bytes(),
+    }
+
+
+BENCHMARKS = {"train": bench_train, "query": bench_query, "neuro": bench_neuro}
+
+
+def run(hidden_sizes: list, batch_sizes: list, dtypes: list, records: int, repeats: int, benchmarks: list) -> dict:
+    configurations = []
+    for name in benchmarks:
+        for hidden_nodes, batch_size in itertools.product(hidden_sizes, batch_sizes):
+            for dtype in (["float64"] if name == "neuro" else dtypes):
+                configurations.append((name, hidden_nodes, batch_size, dtype))
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for name, hidden_nodes, batch_size, dtype in configurations:
+        # * a fresh process per configuration: peak RSS and BLAS state are not shared
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(BENCHMARKS[name], hidden_nodes, batch_size, dtype, records, repeats).result()
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "scipy": scipy.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "parameters": {"records": records, "repeats": repeats, "seed": SEED},
+        "results": results,
+    }
+
+
+def _key(result: dict) -> tuple:
+    return result["benchmark"], result["hidden_nodes"], result["batch_size"], result["dtype"]
+
+
+# * the same on every run of the same code, gated by default
+MEMORY_METRICS = ("peak_rss_bytes", "retained_blocks_per_step", "transient_peak_bytes")
+# * noisy, gated with timings=True only, their tolerance grows with the measured spread
+TIMING_METRICS = ("records_per_second", "latency_ms_p50", "latency_ms_p99")
+# ! runs differ by more than their repeats do (CPU placement, frequency, neighbours): ~2x the spread was seen on a shared host
+NOISE_FACTOR = 3.0
+
+
+def compare(current: dict, baseline: dict, tolerance: float = 0.1, timings: bool = False) -> list:
+    # * regressions: throughput lower or latency / memory / allocations higher than baseline by more than tolerance
+    # * higher is better for records_per_second, lower is better for the rest
+    # ! a timing only regresses beyond tolerance + NOISE_FACTOR * the larger spread of the two runs
+    baseline_results = {_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        reference = baseline_results.get(_key(result))
+        if reference is None:
+            continue
+        for metric in MEMORY_METRICS + (TIMING_METRICS if timings else ()):
+            if metric not in result or metric not in reference:
+                continue
+            allowed = tolerance
+            if metric in TIMING_METRICS:
+                allowed += NOISE_FACTOR * max(result.get("spread", {}).get(metric, 0.0), reference.get("spread", {}).get(metric, 0.0))
+            if reference[metric]:
+                change = result[metric] / reference[metric] - 1
+            else:
+                # ! an allocation-free baseline: any allocation per step is a regression
+                change = float("inf") if result[metric] > 0 else 0.0
+            if metric == "records_per_second":
+                change = -change
+            if change > allowed:
+                regressions.append({"configuration": _key(result), "metric": metric, "baseline": reference[metric], "current": result[metric], "change": change, "allowed": allowed})
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmarks for nn.neuralNetwork and neuro.neural_network")
+    parser.add_argument("--hidden-sizes", type=int, nargs="+", default=[100, 200, 500])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32, 256])
+    parser.add_argument("--dtypes", nargs="+", default=["float64", "float32"])
+    parser.add_argument("--benchmarks", nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("--records", type=int, default=2048)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", help="write the results as json")
+    parser.add_argument("--baseline", help="json of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression")
+    parser.add_argument("--gate-timings", action="store_true", help="also fail on throughput and latency, with a spread-aware tolerance")
+    args = parser.parse_args()
+
+    results = run(args.hidden_sizes, args.batch_sizes, args.dtypes, args.records, args.repeats, args.benchmarks)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance, timings=args.gate_timings)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
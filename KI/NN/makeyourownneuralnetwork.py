@@ -1,15 +1,35 @@
 # * glob helps selct multiple files using patterns
+import concurrent.futures
 import glob
 import numpy as np
 from matplotlib import image
 
+def _decode_into(row, image_file_name: str) -> None:
+    img_array = image.imread(image_file_name)
+    if img_array.ndim == 3:
+        # rgb(a) -> grey, the alpha channel is ignored
+        img_array = img_array[..., :3].mean(axis=2)
+    if img_array.dtype.kind == "f":
+        # ! png is read as 0.0 - 1.0, MNIST pixels are 0 - 255
+        img_array = img_array * 255.0
+    # * MNIST digits are white on black, our images black on white
+    row[:] = 255.0 - img_array.reshape(784)
+
+def load_images(pattern: str = "my_own_images/2828_my_own_?.png", workers: int | None = None, dtype=np.float64):
+    # * decodes all images with a thread pool straight into one preallocated (N, 785) array: label + pixels
+    # * returns (labels, inputs) like mnist_data_set.load_data, with the inputs already scaled for neuralNetwork
+    image_file_names = sorted(glob.glob(pattern))
+    records = np.empty((len(image_file_names), 785), dtype=dtype)
+    # the label is the last character before .png
+    records[:, 0] = [int(image_file_name[-5:-4]) for image_file_name in image_file_names]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # list() re-raises the first decode error
+        list(pool.map(_decode_into, records[:, 1:], image_file_names))
+    # scale to 0.01 - 1, in place for all images at once
+    records[:, 1:] *= 0.99 / 255.0
+    records[:, 1:] += 0.01
+    return records[:, 0].astype(np.intp), records[:, 1:]
+
 if __name__ == "__main__":
-    our_own_dataset = []
-    for image_file_name in glob.glob("my_own_images/2828_my_own_?.png"):
-        label = int(image_file_name[-5:-4])
-        print(f"loading ... {image_file_name} with label {label}")
-        img_array = image.imread(image_file_name)
-        #img_data = 255.0 - img_array.reshape(784)
-        img_data = (img_array / 255.0 * 0.99) + 0.01
-        record = np.append(label, img_data)
-        our_own_dataset.append(record)
\ No newline at end of file
+    labels, inputs = load_images("my_own_images/2828_my_own_?.png")
+    print(f"loaded {inputs.shape[0]} images with labels {labels}")
@@ -1,3 +1,9 @@
+import hashlib
+import itertools
+import json
+import os
+import queue
+import threading
 import numpy
 import matplotlib.pyplot as plt
 
@@ -7,21 +13,147 @@ def get_data(path:str = "mnist_dataset/mnist_train_100.csv"):
     data_file.close()
     return data_list
 
+def _csv_fingerprint(path: str, validate: str) -> dict:
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size}
+    if validate == "mtime":
+        fingerprint["mtime_ns"] = stat.st_mtime_ns
+    elif validate == "hash":
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        fingerprint["sha1"] = sha1.hexdigest()
+    else:
+        raise ValueError(f"unknown validate mode: {validate}")
+    return fingerprint
+
+def load_data(path: str = "mnist_dataset/mnist_train_100.csv", validate: str = "mtime"):
+    # * parse the csv only once into a (N, 785) uint8 array: label + 784 pixels
+    # * the array is stored next to the csv as <path>.npy and memory-mapped on later calls
+    # * validate="mtime" compares size and mtime of the csv, validate="hash" its sha1
+    cache_path = path + ".npy"
+    meta_path = cache_path + ".json"
+    fingerprint = _csv_fingerprint(path, validate)
+
+    records = None
+    if os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if all(meta.get(key) == value for key, value in fingerprint.items()):
+            records = numpy.load(cache_path, mmap_mode="r")
+
+    if records is None:
+        parsed = numpy.loadtxt(path, delimiter=",", dtype=numpy.uint8, ndmin=2)
+        # ! write to a temp file first, so an interrupted run never leaves a broken cache
+        numpy.save(cache_path + ".tmp.npy", parsed)
+        os.replace(cache_path + ".tmp.npy", cache_path)
+        # store both fingerprints, so either validate mode can reuse the cache later
+        with open(meta_path, "w") as f:
+            json.dump({**_csv_fingerprint(path, "mtime"), **_csv_fingerprint(path, "hash")}, f)
+        records = numpy.load(cache_path, mmap_mode="r")
+
+    return records[:, 0], records[:, 1:]
+
+def _read_csv_chunks(path: str, chunk_rows: int):
+    with open(path, "r") as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                return
+            # * one bulk parse per chunk instead of split() per line
+            yield numpy.loadtxt(lines, delimiter=",", dtype=numpy.uint8, ndmin=2)
+
+def _prefetch(chunks, depth: int = 1):
+    # * a background thread parses the next chunk while the current one trains
+    # * at most depth chunks wait in the queue, so memory stays bounded
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                while not stop.is_set():
+                    try:
+                        buffer.put(chunk, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            buffer.put(done)
+        except BaseException as error:
+            # ! hand the error over to the consumer instead of dying silently
+            buffer.put(error)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # the consumer may stop early, e.g. with break
+        stop.set()
+
+def iter_csv_batches(path: str = "mnist_dataset/mnist_train_100.csv", batch_size: int = 32, chunk_rows: int = 4096, prefetch: bool = False):
+    # * streams a csv of any size as (labels, pixels) uint8 batches of batch_size records
+    # * peak memory is a few chunks of chunk_rows records, not the whole file
+    chunk_rows = -(-chunk_rows // batch_size) * batch_size  # ! multiple of batch_size: only the last batch can be smaller
+    chunks = _read_csv_chunks(path, chunk_rows)
+    if prefetch:
+        chunks = _prefetch(chunks)
+    for records in chunks:
+        for start in range(0, records.shape[0], batch_size):
+            batch = records[start:start + batch_size]
+            yield batch[:, 0], batch[:, 1:]
+
+def iter_record_batches(labels, pixels, batch_size: int = 32, shuffle: bool = False):
+    # * yields (labels, pixels) batches of arrays that are already parsed, e.g. memory-mapped caches
+    # * shuffle permutes the order of the batches, the reads inside a batch stay sequential
+    starts = numpy.arange(0, len(labels), batch_size)
+    if shuffle:
+        numpy.random.shuffle(starts)
+    for start in starts:
+        yield labels[start:start + batch_size], pixels[start:start + batch_size]
+
+def scale_inputs(pixels, dtype=float):
+    # scale to 0.01 - 1
+    return (numpy.asarray(pixels, dtype=dtype) / 255.0 * 0.99) + 0.01
+
+def make_targets(labels, onodes: int = 10, dtype=float):
+    targets = numpy.zeros((len(labels), onodes), dtype=dtype) + 0.01
+    targets[numpy.arange(len(labels)), labels] = 0.99
+    return targets
+
 if __name__ == "__main__":
     data_list = get_data()
     print(f"number of images: {len(data_list)}") # , and 1st image looks like: {data_list[1]}")
 
-    # rearrange to 28*28 
+    # rearrange to 28*28
     all_values = data_list[1].split(",")
-    # image_array = numpy.asfarray(all_values[1:]).reshape((28, 28)) # return an float array
+    # image_array = numpy.asarray(all_values[1:], dtype=float).reshape((28, 28)) # return an float array
     # plt.imshow(image_array, cmap="Greys", interpolation="None")
     # plt.show()
 
     # scale to 0.01 - 1
-    scaled_input = (numpy.asfarray(all_values[1:]) / 255.0 * 0.99) + 0.01
-    
+    scaled_input = (numpy.asarray(all_values[1:], dtype=float) / 255.0 * 0.99) + 0.01
+
     # output nodes is 10
     onodes = 10
     targets = numpy.zeros(onodes) + 0.01
     targets[int(all_values[0])] = 0.99
-    print(targets)
\ No newline at end of file
+    print(targets)
+
+    # * binary cache: parsed once, memory-mapped afterwards
+    labels, pixels = load_data()
+    print(f"cached images: {pixels.shape}, {pixels.dtype}, labels: {labels[:10]}")
+
+    # * streaming: fixed-size batches, parsed in chunks by a background thread
+    for labels, pixels in iter_csv_batches(batch_size=32, chunk_rows=64, prefetch=True):
+        print(f"batch: {pixels.shape}, labels: {labels[:5]}")
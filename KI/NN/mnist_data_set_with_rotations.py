@@ -1,19 +1,85 @@
+import concurrent.futures
+import hashlib
+import json
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.ndimage
 
+from mnist_data_set import load_data
+
+def rotate_stack(images, angle: float, order: int = 1):
+    # * rotates a whole (N, 28, 28) stack in one scipy call, around the image plane (axes 1 and 2)
+    # * works on raw 0-255 pixels: background 0 here is the 0.01 of the scaled inputs
+    rotated = scipy.ndimage.rotate(images.astype(np.float32), angle, axes=(1, 2), cval=0.0, order=order, reshape=False)
+    return np.clip(np.rint(rotated), 0, 255).astype(np.uint8)
+
+def _rotate_chunk(pixels, angles: tuple, order: int):
+    # ! returns the original plus one rotation per angle, interleaved per record:
+    # ! so every slice of the result mixes all rotations
+    images = pixels.reshape(-1, 28, 28)
+    stack = [images] + [rotate_stack(images, angle, order) for angle in angles]
+    return np.stack(stack, axis=1).reshape(-1, 784)
+
+def augment(labels, pixels, out_labels, out_pixels, angles: tuple = (10.0, -10.0), order: int = 1, workers: int | None = None, chunk_size: int = 2048) -> None:
+    # * writes the augmented set into out_labels / out_pixels, which hold len(labels) * (len(angles) + 1) records
+    # * chunks of chunk_size images are rotated in a process pool
+    copies = len(angles) + 1
+    out_labels[...] = np.repeat(labels, copies)
+    starts = range(0, len(labels), chunk_size)
+    if workers == 1 or len(starts) == 1:
+        results = (_rotate_chunk(pixels[start:start + chunk_size], angles, order) for start in starts)
+        for start, rotated in zip(starts, results):
+            out_pixels[start * copies:start * copies + rotated.shape[0]] = rotated
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(_rotate_chunk, np.asarray(pixels[start:start + chunk_size]), angles, order): start
+            for start in starts
+        }
+        for future in concurrent.futures.as_completed(futures):
+            rotated = future.result()
+            start = futures[future] * copies
+            out_pixels[start:start + rotated.shape[0]] = rotated
+
+def load_augmented(path: str = "mnist_dataset/mnist_train_100.csv", angles: tuple = (10.0, -10.0), order: int = 1, workers: int | None = None):
+    # * rotates the dataset once and caches it next to the csv, keyed by csv and rotation parameters
+    # * returns memory-mapped (labels, pixels) like load_data, so training can stream from it
+    labels, pixels = load_data(path)
+    stat = os.stat(path)
+    parameters = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "angles": [float(angle) for angle in angles], "order": order}
+    key = hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:12]
+    cache_path = f"{path}.rot-{key}.npy"
+
+    if not os.path.exists(cache_path):
+        temp_path = cache_path + ".tmp.npy"
+        records = np.lib.format.open_memmap(temp_path, mode="w+", dtype=np.uint8, shape=(len(labels) * (len(angles) + 1), 785))
+        augment(labels, pixels, records[:, 0], records[:, 1:], angles=angles, order=order, workers=workers)
+        records.flush()
+        del records
+        # ! only a complete cache gets the final name
+        os.replace(temp_path, cache_path)
+
+    records = np.load(cache_path, mmap_mode="r")
+    return records[:, 0], records[:, 1:]
+
 if __name__ == "__main__":
     data_file = open("mnist_dataset/mnist_train_100.csv", "r")
     data_list = data_file.readlines()
     data_file.close()
     record = 6
     all_values = data_list[record].split(",")
-    scaled_input = ((np.asfarray(all_values[1:]) / 255.0 * 0.99) + 0.01).reshape(28, 28)
+    scaled_input = ((np.asarray(all_values[1:], dtype=float) / 255.0 * 0.99) + 0.01).reshape(28, 28)
     # plt.imshow(scaled_input, cmap="Greys", interpolation="None")
     # plt.show()
     # * rotated anticlockwise by 10 degrees
     inputs_plus10_img = scipy.ndimage.rotate(scaled_input, 10.0, cval=0.01, order=1, reshape=False)
     # * rotated clockwise by 10 degrees
     inputs_minus10_img = scipy.ndimage.rotate(scaled_input, -10.0, cval=0.01, order=1, reshape=False)
+
+    # * the whole training set at once, cached on disk
+    labels, pixels = load_augmented("mnist_dataset/mnist_train_100.csv", angles=(10.0, -10.0))
+    print(f"augmented images: {pixels.shape}")
+
     plt.imshow(inputs_minus10_img, cmap="Greys", interpolation="None")
-    plt.show()
\ No newline at end of file
+    plt.show()
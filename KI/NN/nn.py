@@ -1,69 +1,429 @@
  # ! delta_weight = learning_rate * E_k * O_k * (1 - O_k) * O_j
+ # ! for other activation functions O_k * (1 - O_k) becomes f'(x), see activations.get_derivative
 
+import json
+import os
+import time
 import numpy
-# for sigmoid
-import scipy.special
+# for in-place weight updates (C += alpha * A @ B)
+import scipy.linalg.blas
+# for the sparse input path
+import scipy.sparse
+
+from activations import fast_sigmoid, get_activation, get_derivative, sigmoid_error
+
+# * checkpoint layout: magic, header length (uint64), json header, raw weight matrices
+# * every matrix starts at a multiple of 64 bytes, so load(mmap=True) maps it without copying
+CHECKPOINT_MAGIC = b"NNCKPT01"
+CHECKPOINT_ALIGNMENT = 64
+
+class PhaseProfile:
+    # cumulative wall time, call counts and FLOP estimates per phase of training and query_batch
+    # * lap(phase) books the time since the previous lap (or begin) onto phase
+    # * FLOPs: 2 per multiply-add of a matrix product, 1 per element of an elementwise kernel
+    PHASES = ("input", "forward", "activation", "backward", "update", "checkpoint")
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.calls = dict.fromkeys(self.PHASES, 0)
+        self.flops = dict.fromkeys(self.PHASES, 0)
+        self._last = time.perf_counter()
+
+    def begin(self) -> None:
+        self._last = time.perf_counter()
+
+    def lap(self, phase: str, flops: int = 0) -> None:
+        now = time.perf_counter()
+        self.seconds[phase] += now - self._last
+        self.calls[phase] += 1
+        self.flops[phase] += flops
+        self._last = now
+
+    def snapshot(self) -> dict:
+        total_seconds = sum(self.seconds.values())
+        phases = {}
+        for phase in self.PHASES:
+            seconds = self.seconds[phase]
+            phases[phase] = {
+                "seconds": seconds,
+                "calls": self.calls[phase],
+                "flops": self.flops[phase],
+                "gflops_per_second": self.flops[phase] / seconds / 1e9 if seconds else 0.0,
+                "share": seconds / total_seconds if total_seconds else 0.0,
+            }
+        return {"phases": phases, "total_seconds": total_seconds, "total_flops": sum(self.flops.values())}
 
 class neuralNetwork:
-    def __init__(self, inputnodes: int, hiddennodes: int, outputnodes: int, learningrate: float) -> None:
+    def __init__(self, inputnodes: int, hiddennodes: int, outputnodes: int, learningrate: float, dtype=numpy.float64, wih=None, who=None, activation: str = "sigmoid", activation_parameter: float = 0.01) -> None:
         self.inodes = inputnodes
         self.hnodes = hiddennodes
         self.onodes = outputnodes
+        # * float32 halves weight size and memory bandwidth, every array of the network uses this dtype
+        self.dtype = numpy.dtype(dtype)
 
         # weights
         # * loc: mean of the distribution
         # * scale: standard deviation
         # * size: number of random to create
-        self.wih = numpy.random.normal(loc=0.0, scale=pow(self.inodes, -0.5), size=(self.hnodes, self.inodes))
-        self.who = numpy.random.normal(loc=0.0, scale=pow(self.hnodes, -0.5), size=(self.onodes, self.hnodes))
+        # ! given weights (e.g. memory-mapped from a checkpoint) are used as they are, without a copy
+        if wih is None:
+            wih = numpy.random.normal(loc=0.0, scale=pow(self.inodes, -0.5), size=(self.hnodes, self.inodes))
+        if who is None:
+            who = numpy.random.normal(loc=0.0, scale=pow(self.hnodes, -0.5), size=(self.onodes, self.hnodes))
+        self.wih = numpy.asarray(wih, dtype=self.dtype)
+        self.who = numpy.asarray(who, dtype=self.dtype)
 
         self.lr = learningrate
 
-        # sigmoid function
-        self.activation_function = lambda x: scipy.special.expit(x)
+        # * sigmoid, tanh, relu, leaky_relu or softplus, all keep the dtype of their input
+        # * activation_parameter is the slope of leaky_relu for negative inputs
+        self.activation = activation
+        self.activation_parameter = activation_parameter
+        self.activation_function = get_activation(activation, activation_parameter)
+        # errors *= f'(x), computed from the cached forward output f(x)
+        self.activation_derivative = get_derivative(activation, activation_parameter)
+        # query and query_batch use this one, see enable_fast_inference
+        self.inference_function = self.activation_function
 
-    def train(self, inputs_list, targets_list):
-        # convert inputs list to 2d array
-        inputs = numpy.array(inputs_list, ndmin=2).T
-        targets = numpy.array(targets_list, ndmin=2).T
+        # * preallocated buffers for the training step, one set per mini-batch size
+        self._workspaces = {}
 
-        # calculate signals into hiden layer
-        hidden_inputs = numpy.dot(self.wih, inputs)
-        # calculate the signals emerging from hidden layer
-        hidden_outputs = self.activation_function(hidden_inputs)
+        # * optional sparse input path, see enable_sparse_inputs: None keeps the dense product
+        self.input_offset = None
+        self.sparse_max_density = 0.0
+        self.input_batches = {"sparse": 0, "dense": 0}
 
-        # calculate signals into final output layer
-        final_inputs = numpy.dot(self.who, hidden_outputs)
-        # calculate the signals emerging from final output layer
-        final_outputs = self.activation_function(final_inputs)
+        # * optional instrumentation, see enable_profiling: None costs one check per phase
+        self.profile = None
+        # hook(network, epoch, snapshot) for every end_epoch call
+        self.epoch_hooks = []
 
-        # output layer error is the (target - actual)
-        output_errors = targets - final_outputs
-        # hidden layer error is the output_errors, split by weights, recombined at hidden nodes
-        hidden_errors = numpy.dot(self.who.T, output_errors)
+    def _workspace(self, batch_size: int) -> dict:
+        workspace = self._workspaces.get(batch_size)
+        if workspace is None:
+            workspace = {
+                "inputs": numpy.empty((batch_size, self.inodes), dtype=self.dtype),
+                "targets": numpy.empty((batch_size, self.onodes), dtype=self.dtype),
+                "hidden_outputs": numpy.empty((batch_size, self.hnodes), dtype=self.dtype),
+                "final_outputs": numpy.empty((batch_size, self.onodes), dtype=self.dtype),
+                "output_errors": numpy.empty((batch_size, self.onodes), dtype=self.dtype),
+                "hidden_errors": numpy.empty((batch_size, self.hnodes), dtype=self.dtype),
+            }
+            self._workspaces[batch_size] = workspace
+        return workspace
 
-        # update the weights for the links between the hidden and output layers
-        self.who += self.lr * numpy.dot((output_errors * final_outputs * (1 - final_outputs)), numpy.transpose(hidden_outputs))
+    def enable_sparse_inputs(self, offset: float = 0.01, max_density: float | None = None, batch_size: int = 32) -> float:
+        # * inputs = offset + residual, where the residual is 0 for every background pixel (0.01 after scale_inputs)
+        # * inputs @ wih.T = offset * rowsum(wih) + residual @ wih.T, the second product with a CSR matrix
+        # * a batch takes the sparse path if its measured density of nonzero residuals is at most max_density
+        # ! max_density=None measures the crossover against the dense BLAS product for this shape, dtype and batch_size,
+        # ! the measurement is timing based and may differ between runs, pass max_density for a fixed choice
+        # ! unlike the dense path, the sparse path allocates its CSR arrays for every batch
+        self.input_offset = self.dtype.type(offset)
+        if max_density is None:
+            max_density = self._sparse_crossover(batch_size)
+        self.sparse_max_density = max_density
+        return max_density
 
-        # update the weights for the links between the input and hidden layers
-        self.wih += self.lr * numpy.dot((hidden_errors * hidden_outputs * (1 - hidden_outputs)), numpy.transpose(inputs))
+    def disable_sparse_inputs(self) -> None:
+        self.input_offset = None
+
+    def _sparse_crossover(self, batch_size: int, repeats: int = 5) -> float:
+        # highest density at which the sparse path beat the dense product, 0.0 if it never did
+        rng = numpy.random.default_rng(0)
+        out = numpy.empty((batch_size, self.hnodes), dtype=self.dtype)
+        crossover = 0.0
+        for density in (0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5):
+            inputs = numpy.full((batch_size, self.inodes), self.input_offset, dtype=self.dtype)
+            signal = rng.random(inputs.shape) < density
+            inputs[signal] += rng.random(numpy.count_nonzero(signal)).astype(self.dtype)
+            timings = {}
+            for path, product in (("sparse", self._sparse_input_signals), ("dense", self._dense_input_signals)):
+                product(inputs, out)
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    product(inputs, out)
+                timings[path] = time.perf_counter() - start
+            if timings["sparse"] >= timings["dense"]:
+                break
+            crossover = density
+        return crossover
+
+    def _input_signals(self, inputs, out) -> int:
+        # out = inputs @ wih.T, returns the FLOP estimate for the profile
+        # ! with a crossover of 0 the residual is never built, the dense step stays allocation-free
+        if self.input_offset is not None and self.sparse_max_density > 0:
+            # ! one dense pass to measure the density, far cheaper than the product itself
+            residual = inputs - self.input_offset
+            nonzero = numpy.count_nonzero(residual)
+            if nonzero <= self.sparse_max_density * residual.size:
+                self.input_batches["sparse"] += 1
+                return self._sparse_input_signals(inputs, out, residual)
+        self.input_batches["dense"] += 1
+        return self._dense_input_signals(inputs, out)
+
+    def _dense_input_signals(self, inputs, out) -> int:
+        numpy.dot(inputs, self.wih.T, out=out)
+        return 2 * inputs.shape[0] * self.hnodes * self.inodes
+
+    def _sparse_input_signals(self, inputs, out, residual=None) -> int:
+        if residual is None:
+            residual = inputs - self.input_offset
+        # * CSR straight from the mask, cheaper than scipy's generic dense -> sparse conversion
+        mask = residual != 0
+        indptr = numpy.zeros(residual.shape[0] + 1, dtype=numpy.intp)
+        numpy.cumsum(numpy.count_nonzero(mask, axis=1), out=indptr[1:])
+        columns = numpy.flatnonzero(mask) % residual.shape[1]
+        sparse = scipy.sparse.csr_matrix((residual[mask], columns, indptr), shape=residual.shape)
+        out[...] = sparse @ self.wih.T
+        # ! the weights change with every training step, so the offset term is recomputed each time
+        out += self.input_offset * numpy.sum(self.wih, axis=1)
+        return 2 * sparse.nnz * self.hnodes + self.hnodes * self.inodes
+
+    def enable_profiling(self) -> PhaseProfile:
+        # * per-phase timing for train, train_batch and query_batch, until disable_profiling
+        if self.profile is None:
+            self.profile = PhaseProfile()
+        return self.profile
+
+    def disable_profiling(self) -> dict | None:
+        # returns the last snapshot
+        profile, self.profile = self.profile, None
+        return profile.snapshot() if profile else None
+
+    def add_epoch_hook(self, hook) -> None:
+        self.epoch_hooks.append(hook)
+
+    def end_epoch(self, epoch: int) -> None:
+        # ! the training loop lives in the caller, so the caller marks the end of every epoch
+        snapshot = self.profile.snapshot() if self.profile else None
+        for hook in self.epoch_hooks:
+            hook(self, epoch, snapshot)
+
+    def train(self, inputs_list, targets_list):
+        profile = self.profile
+        if profile:
+            profile.begin()
+        # * copy the record into the preallocated (1, inodes) buffers, no new arrays per call
+        workspace = self._workspace(1)
+        workspace["inputs"][0] = inputs_list
+        workspace["targets"][0] = targets_list
+        if profile:
+            profile.lap("input")
+        self._train_mini_batch(workspace["inputs"], workspace["targets"])
 
     def query(self, inputs_list):
         # convert inputs list to 2d array
-        inputs = numpy.array(inputs_list, ndmin=2).T
+        inputs = numpy.array(inputs_list, ndmin=2, dtype=self.dtype).T
 
         # calculate signals into hidden layer
         hidden_inputs = numpy.dot(self.wih, inputs)
         # calculate the signals emerging from hidden layer
-        hidden_outputs = self.activation_function(hidden_inputs)
+        hidden_outputs = self.inference_function(hidden_inputs)
 
         # calculate signals into final output layer
         final_input = numpy.dot(self.who, hidden_outputs)
         # calculate the singals emerging from final output layer
-        final_outputs = self.activation_function(final_input)
+        final_outputs = self.inference_function(final_input)
+
+        return final_outputs
 
+    def query_batch(self, inputs):
+        # * inputs: (N, inodes) -> outputs: (N, onodes), both layers in one pass
+        profile = self.profile
+        if profile:
+            profile.begin()
+        inputs = numpy.asarray(inputs, dtype=self.dtype)
+        if profile:
+            profile.lap("input")
+            n = inputs.shape[0]
+        hidden_outputs = numpy.empty((inputs.shape[0], self.hnodes), dtype=self.dtype)
+        flops = self._input_signals(inputs, hidden_outputs)
+        if profile:
+            profile.lap("forward", flops)
+        self.inference_function(hidden_outputs, out=hidden_outputs)
+        if profile:
+            profile.lap("activation", n * self.hnodes)
+        final_outputs = numpy.dot(hidden_outputs, self.who.T)
+        if profile:
+            profile.lap("forward", 2 * n * self.onodes * self.hnodes)
+        self.inference_function(final_outputs, out=final_outputs)
+        if profile:
+            profile.lap("activation", n * self.onodes)
         return final_outputs
-    
+
+    def enable_fast_inference(self, max_error: float = 1e-4) -> float:
+        # * opt-in: query and query_batch use fast_sigmoid instead of expit, training is unchanged
+        # * returns the measured worst-case deviation from expit, which must stay below max_error
+        if self.activation != "sigmoid":
+            raise ValueError(f"fast inference is only available for sigmoid, not {self.activation}")
+        error = sigmoid_error(fast_sigmoid, self.dtype)
+        if error > max_error:
+            raise ValueError(f"fast sigmoid deviates by {error:.2e} in {self.dtype}, more than max_error={max_error:.2e}")
+        self.inference_function = fast_sigmoid
+        return error
+
+    def disable_fast_inference(self) -> None:
+        self.inference_function = self.activation_function
+
+    def train_batch(self, inputs, targets, batch_size: int = 32, checkpoint: str | None = None, checkpoint_seconds: float = 0.0) -> None:
+        # * inputs: (N, inodes), targets: (N, onodes) -> one record per row
+        # * each mini-batch goes through both layers as a single matrix product (GEMM)
+        # * with checkpoint set, the weights are saved after the first mini-batch that ends checkpoint_seconds after the last save
+        # ! a time interval, not a mini-batch count: a save writes all weights, its cost must not grow with the data
+        profile = self.profile
+        if profile:
+            profile.begin()
+        inputs = numpy.ascontiguousarray(inputs, dtype=self.dtype)
+        targets = numpy.ascontiguousarray(targets, dtype=self.dtype)
+        if profile:
+            profile.lap("input")
+        last_save = time.perf_counter()
+        for start in range(0, inputs.shape[0], batch_size):
+            self._train_mini_batch(inputs[start:start + batch_size], targets[start:start + batch_size])
+            if checkpoint and checkpoint_seconds and time.perf_counter() - last_save >= checkpoint_seconds:
+                self.save(checkpoint)
+                last_save = time.perf_counter()
+                if profile:
+                    profile.lap("checkpoint")
+
+    def _train_mini_batch(self, inputs, targets) -> None:
+        # ! steady state allocates nothing: every result goes into a workspace buffer (out=)
+        # ! and the weights are updated in place by BLAS gemm
+        workspace = self._workspace(inputs.shape[0])
+        hidden_outputs = workspace["hidden_outputs"]
+        final_outputs = workspace["final_outputs"]
+        output_errors = workspace["output_errors"]
+        hidden_errors = workspace["hidden_errors"]
+
+        # ! with profiling off every lap is skipped by a single truth test
+        profile = self.profile
+        if profile:
+            n, i, h, o = inputs.shape[0], self.inodes, self.hnodes, self.onodes
+
+        # calculate signals into hidden layer and the signals emerging from it, one row per record
+        flops = self._input_signals(inputs, hidden_outputs)
+        if profile:
+            profile.lap("forward", flops)
+        self.activation_function(hidden_outputs, out=hidden_outputs)
+        if profile:
+            profile.lap("activation", n * h)
+
+        # calculate signals into final output layer and the signals emerging from it
+        numpy.dot(hidden_outputs, self.who.T, out=final_outputs)
+        if profile:
+            profile.lap("forward", 2 * n * o * h)
+        self.activation_function(final_outputs, out=final_outputs)
+        if profile:
+            profile.lap("activation", n * o)
+
+        # output layer error is the (target - actual)
+        numpy.subtract(targets, final_outputs, out=output_errors)
+        # hidden layer error is the output_errors, split by weights, recombined at hidden nodes
+        numpy.dot(output_errors, self.who, out=hidden_errors)
+
+        # * E_k * f'(x_k) in one kernel, reusing O_k = f(x_k) from the forward pass
+        self.activation_derivative(output_errors, final_outputs)
+        if profile:
+            profile.lap("backward", n * o + 2 * n * o * h + 3 * n * o)
+        # update the weights for the links between the hidden and output layers
+        # ! the weight updates are summed over the mini-batch, like n calls of train()
+        self.who = self._add_outer(self.who, output_errors, hidden_outputs)
+        if profile:
+            profile.lap("update", 2 * n * o * h)
+
+        # ! after the who update, hidden_outputs may serve as scratch space for the derivative
+        self.activation_derivative(hidden_errors, hidden_outputs)
+        if profile:
+            profile.lap("backward", 3 * n * h)
+        # update the weights for the links between the input and hidden layers
+        self.wih = self._add_outer(self.wih, hidden_errors, inputs)
+        if profile:
+            profile.lap("update", 2 * n * h * i)
+
+    def _add_outer(self, weights, deltas, signals):
+        # * weights += lr * deltas.T @ signals as one fused gemm call
+        # * weights.T is a Fortran-ordered view of weights, so gemm writes straight into it
+        gemm = scipy.linalg.blas.get_blas_funcs("gemm", (weights,))
+        updated = gemm(self.lr, signals.T, deltas.T, beta=1.0, c=weights.T, trans_b=1, overwrite_c=1)
+        # ! gemm only works in place on contiguous weights, otherwise it returns a copy
+        return updated.T
+
+    def save(self, path: str) -> None:
+        # * one uncompressed file: layer sizes, learning rate, activation name and both weight matrices
+        header = {
+            "inodes": self.inodes,
+            "hnodes": self.hnodes,
+            "onodes": self.onodes,
+            "lr": self.lr,
+            "activation": self.activation,
+            "activation_parameter": self.activation_parameter,
+            "dtype": self.dtype.str,
+            "arrays": {},
+        }
+        weights = {"wih": self.wih, "who": self.who}
+        # the header size depends on the offsets, so pad it to a fixed multiple first
+        header_size = CHECKPOINT_ALIGNMENT * 16
+        offset = header_size
+        for name, array in weights.items():
+            header["arrays"][name] = {"offset": offset, "shape": list(array.shape)}
+            offset += -(-array.nbytes // CHECKPOINT_ALIGNMENT) * CHECKPOINT_ALIGNMENT
+        encoded = json.dumps(header).encode()
+        preamble = len(CHECKPOINT_MAGIC) + 8
+        if preamble + len(encoded) > header_size:
+            raise ValueError("checkpoint header too large")
+
+        # ! write to a temp file first: a crash while saving never destroys the last checkpoint
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(CHECKPOINT_MAGIC)
+            f.write(numpy.uint64(len(encoded)).tobytes())
+            f.write(encoded.ljust(header_size - preamble, b" "))
+            for name, array in weights.items():
+                f.seek(header["arrays"][name]["offset"])
+                f.write(numpy.ascontiguousarray(array).tobytes())
+            f.truncate(offset)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "neuralNetwork":
+        # * mmap=True maps the weights copy-on-write: no read at start, training never touches the file
+        with open(path, "rb") as f:
+            if f.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+                raise ValueError(f"{path} is not a neuralNetwork checkpoint")
+            header_length = int(numpy.frombuffer(f.read(8), dtype=numpy.uint64)[0])
+            header = json.loads(f.read(header_length))
+
+        dtype = numpy.dtype(header["dtype"])
+        weights = {}
+        for name, info in header["arrays"].items():
+            shape = tuple(info["shape"])
+            if mmap:
+                weights[name] = numpy.memmap(path, dtype=dtype, mode="c", offset=info["offset"], shape=shape)
+            else:
+                weights[name] = numpy.fromfile(path, dtype=dtype, count=int(numpy.prod(shape)), offset=info["offset"]).reshape(shape)
+        return cls(header["inodes"], header["hnodes"], header["onodes"], header["lr"], dtype=dtype, wih=weights["wih"], who=weights["who"],
+                   activation=header["activation"], activation_parameter=header.get("activation_parameter", 0.01))
+
+def evaluate(network: neuralNetwork, inputs, labels) -> dict:
+    # * scores a whole test set from the argmax of one query_batch call
+    labels = numpy.asarray(labels, dtype=numpy.intp)
+    predictions = numpy.argmax(network.query_batch(inputs), axis=1)
+    n_classes = network.onodes
+    # rows: correct label, columns: predicted label
+    confusion = numpy.bincount(labels * n_classes + predictions, minlength=n_classes * n_classes).reshape(n_classes, n_classes)
+    predicted_counts = confusion.sum(axis=0)
+    # ! classes that were never predicted get a precision of 0 instead of nan
+    precision = numpy.divide(numpy.diag(confusion), predicted_counts, out=numpy.zeros(n_classes), where=predicted_counts > 0)
+    return {
+        "accuracy": float(numpy.mean(predictions == labels)),
+        "confusion_matrix": confusion,
+        "precision": precision,
+    }
+
 if __name__ == "__main__":
     input_nodes = 3
     hidden_nodes = 3
@@ -1,5 +1,7 @@
-from mnist_data_set import get_data
-from nn import neuralNetwork
+from mnist_data_set import iter_csv_batches, iter_record_batches, load_data, make_targets, scale_inputs
+from mnist_data_set_with_rotations import load_augmented
+from nn import evaluate, neuralNetwork
+from quantize import quantize
 import numpy
 
 if __name__ == "__main__":
@@ -8,34 +10,83 @@ if __name__ == "__main__":
     output_nodes = 10
 
     learning_rate = 0.1
+    batch_size = 10
+    # * float32 is precise enough for this model and halves the memory traffic
+    dtype = numpy.float32
+    # * the weights are saved after every epoch, so a crashed run or an inference worker can start from them
+    # * plus at most once per checkpoint_seconds inside long epochs (the full 60k csv)
+    checkpoint = "nn_mnist.ckpt"
+    checkpoint_seconds = 60.0
+    # * stream the training csv in chunks instead of loading it, for files bigger than RAM
+    stream_training_data = False
+    training_data = "mnist_dataset/mnist_train_100.csv"
+    # * train on the images plus rotated copies, rotated once and streamed from a disk cache
+    augment_rotations = False
+    rotation_angles = (10.0, -10.0)
+    # * time every phase of the training step and print where the time went
+    profile_phases = True
+    # * split the inputs into the constant 0.01 of the background pixels plus a sparse residual,
+    # * used for every batch sparser than the measured crossover with the dense product
+    # ! off: on MNIST the dense BLAS product wins, the measured crossover is 0
+    sparse_inputs = False
 
-    n = neuralNetwork(input_nodes, hidden_nodes, output_nodes, learning_rate)
-    training_data_list = get_data("mnist_dataset/mnist_train_100.csv")
+    n = neuralNetwork(input_nodes, hidden_nodes, output_nodes, learning_rate, dtype=dtype)
+    if sparse_inputs:
+        crossover = n.enable_sparse_inputs(offset=0.01, batch_size=batch_size)
+        print(f"Sparse inputs: used up to a density of {crossover}")
+    if profile_phases:
+        n.enable_profiling()
+        n.add_epoch_hook(lambda network, epoch, snapshot: print(f"Epoch {epoch} done, {snapshot['total_seconds']:.3f}s in the network so far"))
+    # * the csv is parsed once and cached as a memory-mapped uint8 array
+    if augment_rotations:
+        augmented_labels, augmented_pixels = load_augmented(training_data, angles=rotation_angles)
+    elif not stream_training_data:
+        training_labels, training_pixels = load_data(training_data)
+        inputs = scale_inputs(training_pixels, dtype=dtype)
+        targets = make_targets(training_labels, output_nodes, dtype=dtype)
 
     epochs = 5
 
     for e in range(epochs):
         print(f"Epoch: {e}")
-        for record in training_data_list:
-            all_values = record.split(",")
-            inputs = (numpy.asfarray(all_values[1:]) / 255.0 * 0.99) + 0.01
-            targets = numpy.zeros(output_nodes) + 0.01
-            targets[int(all_values[0])] = 0.99
-            n.train(inputs, targets)
-
-    test_data_list = get_data(path="mnist_dataset/mnist_test_10.csv")
-
-    scorecard = []
-    for record in test_data_list:
-        all_values = record.split(",")
-        correct_label = int(all_values[0])
-        inputs = (numpy.asfarray(all_values[1:]) / 255.0 * 0.99) + 0.01
-        outputs = n.query(inputs)
-        label = numpy.argmax(outputs) # index of max value
-        if label == correct_label:
-            scorecard.append(1)
+        if augment_rotations:
+            for labels, pixels in iter_record_batches(augmented_labels, augmented_pixels, batch_size=batch_size, shuffle=True):
+                n.train_batch(scale_inputs(pixels, dtype=dtype), make_targets(labels, output_nodes, dtype=dtype), batch_size=batch_size)
+        elif stream_training_data:
+            for labels, pixels in iter_csv_batches(training_data, batch_size=batch_size, prefetch=True):
+                n.train_batch(scale_inputs(pixels, dtype=dtype), make_targets(labels, output_nodes, dtype=dtype), batch_size=batch_size)
         else:
-            scorecard.append(0)
+            n.train_batch(inputs, targets, batch_size=batch_size, checkpoint=checkpoint, checkpoint_seconds=checkpoint_seconds)
+        n.save(checkpoint)
+        n.end_epoch(e)
+    if sparse_inputs:
+        print(f"Input batches: {n.input_batches}")
 
-    scorecard_array = numpy.asarray(scorecard)
-    print(f"Performace= {scorecard_array.sum() / scorecard_array.size}")
\ No newline at end of file
+    if profile_phases:
+        # ! before the reload below, the loaded network starts without a profile
+        training_profile = n.disable_profiling()
+        print(f"{'phase':<12}{'seconds':>10}{'share':>8}{'calls':>10}{'GFLOP/s':>10}")
+        for phase, stats in training_profile["phases"].items():
+            print(f"{phase:<12}{stats['seconds']:>10.4f}{stats['share']:>8.1%}{stats['calls']:>10}{stats['gflops_per_second']:>10.2f}")
+        print(f"{'total':<12}{training_profile['total_seconds']:>10.4f}")
+
+    # * memory-mapped load: no retraining, no copy of the weights
+    n = neuralNetwork.load(checkpoint, mmap=True)
+
+    test_labels, test_pixels = load_data(path="mnist_dataset/mnist_test_10.csv")
+
+    scores = evaluate(n, scale_inputs(test_pixels, dtype=dtype), test_labels)
+    print(f"Performace= {scores['accuracy']}")
+    print(f"Precision per class= {numpy.round(scores['precision'], 2)}")
+    print(scores["confusion_matrix"])
+
+    # * fast inference: tanh based sigmoid, worst-case deviation and its effect on the accuracy
+    max_deviation = n.enable_fast_inference(max_error=1e-4)
+    fast_scores = evaluate(n, scale_inputs(test_pixels, dtype=dtype), test_labels)
+    n.disable_fast_inference()
+    print(f"Fast inference: worst-case deviation from expit= {max_deviation:.2e}, accuracy delta= {fast_scores['accuracy'] - scores['accuracy']}")
+
+    # * int8 inference: per-row scaled weights, ~8x smaller than float64, and its effect on the accuracy
+    quantized = quantize(n)
+    quantized_scores = evaluate(quantized, scale_inputs(test_pixels, dtype=dtype), test_labels)
+    print(f"Int8 inference: weights {n.wih.nbytes + n.who.nbytes} -> {quantized.nbytes} bytes, accuracy delta= {quantized_scores['accuracy'] - scores['accuracy']}")
@@ -0,0 +1,205 @@
+# data-parallel training of neuralNetwork on all cores
+# * weights and dataset live in multiprocessing.shared_memory, each worker trains on its own shard
+# * mode="hogwild": workers update the shared weights directly without locks
+# * mode="sync": workers train a copy for sync_every mini-batches, then the copies are averaged
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy
+
+from nn import neuralNetwork
+
+# ! every BLAS reads one of these at import time, so they are set before the workers start
+BLAS_THREAD_VARIABLES = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+)
+
+
+class SharedArray:
+    # numpy array in a shared memory block, other processes attach to it by its spec
+    def __init__(self, shape: tuple, dtype, name: str | None = None) -> None:
+        dtype = numpy.dtype(dtype)
+        size = max(int(numpy.prod(shape)) * dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.array = numpy.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def copy_of(cls, array) -> "SharedArray":
+        array = numpy.asarray(array)
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, spec: tuple) -> "SharedArray":
+        name, shape, dtype = spec
+        return cls(shape, dtype, name=name)
+
+    def spec(self) -> tuple:
+        return self.shm.name, self.array.shape, self.array.dtype.str
+
+    def close(self) -> None:
+        # drop the numpy view first, otherwise the buffer cannot be released
+        self.array = None
+        self.shm.close()
+
+    def unlink(self) -> None:
+        self.close()
+        self.shm.unlink()
+
+
+def spawn_pool(workers: int, blas_threads: int, initializer, initargs: tuple):
+    # process pool whose workers use blas_threads BLAS threads each, shared by ParallelTrainer and sweep
+    # ! spawn instead of fork: a fresh interpreter reads the BLAS thread variables on import
+    previous = {name: os.environ.get(name) for name in BLAS_THREAD_VARIABLES}
+    os.environ.update({name: str(blas_threads) for name in BLAS_THREAD_VARIABLES})
+    try:
+        context = multiprocessing.get_context("spawn")
+        # the workers start here, while the variables are set
+        return context.Pool(workers, initializer=initializer, initargs=initargs)
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def pin_blas_threads(blas_threads: int):
+    # call in a worker: pins BLAS threads even if the env variables were ignored, keep the result alive
+    try:
+        # optional
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return None
+    return threadpool_limits(limits=blas_threads)
+
+
+# * per-process state of a worker, filled by _init_worker
+_worker = {}
+
+
+def _init_worker(specs: dict, config: dict) -> None:
+    _worker["limits"] = pin_blas_threads(config["blas_threads"])
+    shared = {key: SharedArray.attach(spec) for key, spec in specs.items()}
+    network = neuralNetwork(config["inodes"], config["hnodes"], config["onodes"], config["lr"], dtype=config["dtype"],
+                            activation=config["activation"], activation_parameter=config["activation_parameter"])
+    if config["mode"] == "hogwild":
+        # the network trains directly on the shared weights
+        network.wih = shared["wih"].array
+        network.who = shared["who"].array
+    _worker.update(shared=shared, network=network, batch_size=config["batch_size"])
+
+
+def _train_hogwild(task: tuple) -> None:
+    start, stop = task
+    shared = _worker["shared"]
+    _worker["network"].train_batch(shared["inputs"].array[start:stop], shared["targets"].array[start:stop], _worker["batch_size"])
+
+
+def _train_sync(task: tuple) -> None:
+    slot, start, stop = task
+    shared = _worker["shared"]
+    network = _worker["network"]
+    network.wih[...] = shared["wih"].array
+    network.who[...] = shared["who"].array
+    network.train_batch(shared["inputs"].array[start:stop], shared["targets"].array[start:stop], _worker["batch_size"])
+    shared["wih_slots"].array[slot] = network.wih
+    shared["who_slots"].array[slot] = network.who
+
+
+class ParallelTrainer:
+    def __init__(
+        self,
+        network: neuralNetwork,
+        workers: int | None = None,
+        mode: str = "hogwild",
+        sync_every: int = 10,  # ! mini-batches per worker between two averaging steps (mode="sync")
+        blas_threads: int = 1,  # ! BLAS threads per worker, workers * blas_threads should match the cores
+    ) -> None:
+        if mode not in ("hogwild", "sync"):
+            raise ValueError(f"unknown mode: {mode}")
+        self.network = network
+        self.workers = workers or os.cpu_count() or 1
+        self.mode = mode
+        self.sync_every = sync_every
+        self.blas_threads = blas_threads
+
+    def train(self, inputs, targets, epochs: int = 1, batch_size: int = 32) -> None:
+        network = self.network
+        inputs = SharedArray.copy_of(numpy.ascontiguousarray(inputs, dtype=network.dtype))
+        targets = SharedArray.copy_of(numpy.ascontiguousarray(targets, dtype=network.dtype))
+        shared = {
+            "inputs": inputs,
+            "targets": targets,
+            "wih": SharedArray.copy_of(network.wih),
+            "who": SharedArray.copy_of(network.who),
+        }
+        if self.mode == "sync":
+            shared["wih_slots"] = SharedArray((self.workers,) + network.wih.shape, network.dtype)
+            shared["who_slots"] = SharedArray((self.workers,) + network.who.shape, network.dtype)
+        config = {
+            "inodes": network.inodes,
+            "hnodes": network.hnodes,
+            "onodes": network.onodes,
+            "lr": network.lr,
+            "dtype": network.dtype.str,
+            "activation": network.activation,
+            "activation_parameter": network.activation_parameter,
+            "mode": self.mode,
+            "batch_size": batch_size,
+            "blas_threads": self.blas_threads,
+        }
+        try:
+            with self._pool({key: array.spec() for key, array in shared.items()}, config) as pool:
+                for _ in range(epochs):
+                    if self.mode == "hogwild":
+                        pool.map(_train_hogwild, self._shards(inputs.array.shape[0]))
+                    else:
+                        self._sync_epoch(pool, shared, inputs.array.shape[0], batch_size)
+            network.wih = shared["wih"].array.copy()
+            network.who = shared["who"].array.copy()
+        finally:
+            for array in shared.values():
+                array.unlink()
+
+    def _shards(self, records: int) -> list:
+        # disjoint, contiguous slices of the dataset, one per worker
+        bounds = numpy.linspace(0, records, self.workers + 1).astype(int)
+        return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+    def _sync_epoch(self, pool, shared: dict, records: int, batch_size: int) -> None:
+        step = self.sync_every * batch_size
+        shards = self._shards(records)
+        longest = max(stop - start for start, stop in shards)
+        for offset in range(0, longest, step):
+            tasks = []
+            for slot, (start, stop) in enumerate(shards):
+                if start + offset < stop:
+                    tasks.append((slot, start + offset, min(start + offset + step, stop)))
+            pool.map(_train_sync, tasks)
+            # * averaging the trained copies == applying the averaged updates of all workers
+            slots = [slot for slot, _, _ in tasks]
+            numpy.mean(shared["wih_slots"].array[slots], axis=0, out=shared["wih"].array)
+            numpy.mean(shared["who_slots"].array[slots], axis=0, out=shared["who"].array)
+
+    def _pool(self, specs: dict, config: dict):
+        return spawn_pool(self.workers, self.blas_threads, _init_worker, (specs, config))
+
+
+if __name__ == "__main__":
+    from mnist_data_set import load_data, make_targets, scale_inputs
+    from nn import evaluate
+
+    n = neuralNetwork(784, 200, 10, 0.1, dtype=numpy.float32)
+    labels, pixels = load_data("mnist_dataset/mnist_train_100.csv")
+    trainer = ParallelTrainer(n, workers=4, mode="sync", sync_every=2)
+    trainer.train(scale_inputs(pixels, dtype=numpy.float32), make_targets(labels, dtype=numpy.float32), epochs=5, batch_size=10)
+
+    test_labels, test_pixels = load_data("mnist_dataset/mnist_test_10.csv")
+    print(f"Performace= {evaluate(n, scale_inputs(test_pixels, dtype=numpy.float32), test_labels)['accuracy']}")
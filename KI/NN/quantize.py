@@ -0,0 +1,86 @@
+# post-training int8 quantization of a trained neuralNetwork, for inference only
+# * every weight row (one hidden / output node) gets its own scale: w ~ scale_row * q, q in [-127, 127]
+# * each record entering a layer is quantized the same way, with a scale computed on the fly
+# * the matrix product runs on the int8 values with int32 accumulation, then it is rescaled to float32
+# ! 1 byte per weight instead of 8 (float64) or 4 (float32), the weights of many models fit into L2/L3 cache
+# ! this is for size, not speed: numpy has no integer BLAS, its int8 products are 20-40x slower than sgemm
+import numpy
+
+from activations import get_activation
+from nn import neuralNetwork
+
+INT8_MAX = 127
+
+
+def quantize_rows(matrix) -> tuple:
+    # symmetric per-row quantization: (int8 matrix, float32 scale per row)
+    matrix = numpy.asarray(matrix, dtype=numpy.float32)
+    scales = numpy.max(numpy.abs(matrix), axis=1) / INT8_MAX
+    # ! all-zero rows would divide by zero, any scale reproduces them
+    scales[scales == 0] = 1.0
+    quantized = numpy.rint(matrix / scales[:, None])
+    numpy.clip(quantized, -INT8_MAX, INT8_MAX, out=quantized)
+    return quantized.astype(numpy.int8), scales
+
+
+class QuantizedNetwork:
+    # frozen: the arrays are read-only and there is no train, query_batch matches neuralNetwork.query_batch
+    def __init__(self, network: neuralNetwork) -> None:
+        self.inodes = network.inodes
+        self.hnodes = network.hnodes
+        self.onodes = network.onodes
+        self.activation = network.activation
+        self.activation_parameter = network.activation_parameter
+        self.activation_function = get_activation(network.activation, network.activation_parameter)
+        self.wih, self.wih_scales = quantize_rows(network.wih)
+        self.who, self.who_scales = quantize_rows(network.who)
+        for array in (self.wih, self.wih_scales, self.who, self.who_scales):
+            array.flags.writeable = False
+
+    @property
+    def nbytes(self) -> int:
+        return self.wih.nbytes + self.wih_scales.nbytes + self.who.nbytes + self.who_scales.nbytes
+
+    def _layer(self, inputs, weights, weight_scales):
+        # (N, in) float -> (N, out) float32: int8 x int8 products summed in int32, then both scales
+        # ! the weights are read as int8, no wider copy of them is made
+        quantized_inputs, input_scales = quantize_rows(inputs)
+        # ! int8 * int8 sums of up to ~2^17 terms fit into int32 without overflow
+        # ! einsum casts through a small fixed buffer, matmul(..., dtype=int32) would cast all weights to int32 first
+        accumulators = numpy.einsum("ni,hi->nh", quantized_inputs, weights, dtype=numpy.int32)
+        outputs = accumulators.astype(numpy.float32)
+        outputs *= input_scales[:, None]
+        outputs *= weight_scales
+        return self.activation_function(outputs, out=outputs)
+
+    def query_batch(self, inputs):
+        # * inputs: (N, inodes) -> outputs: (N, onodes) in float32
+        inputs = numpy.atleast_2d(inputs)
+        hidden_outputs = self._layer(inputs, self.wih, self.wih_scales)
+        return self._layer(hidden_outputs, self.who, self.who_scales)
+
+    def query(self, inputs_list):
+        # column vector like neuralNetwork.query
+        return self.query_batch(numpy.asarray(inputs_list, dtype=numpy.float32).reshape(1, self.inodes)).T
+
+
+def quantize(network: neuralNetwork) -> QuantizedNetwork:
+    return QuantizedNetwork(network)
+
+
+if __name__ == "__main__":
+    from mnist_data_set import load_data, make_targets, scale_inputs
+    from nn import evaluate
+
+    n = neuralNetwork(784, 200, 10, 0.1)
+    labels, pixels = load_data("mnist_dataset/mnist_train_100.csv")
+    for _ in range(5):
+        n.train_batch(scale_inputs(pixels), make_targets(labels), batch_size=10)
+
+    quantized = quantize(n)
+    test_labels, test_pixels = load_data("mnist_dataset/mnist_test_10.csv")
+    test_inputs = scale_inputs(test_pixels)
+    float_accuracy = evaluate(n, test_inputs, test_labels)["accuracy"]
+    int8_accuracy = evaluate(quantized, test_inputs, test_labels)["accuracy"]
+    print(f"weights: {n.wih.nbytes + n.who.nbytes} bytes ({n.dtype}) -> {quantized.nbytes} bytes (int8 + scales)")
+    print(f"Performace= {float_accuracy} (float), {int8_accuracy} (int8), accuracy delta= {int8_accuracy - float_accuracy}")
@@ -0,0 +1,177 @@
+# asyncio serving layer around neuralNetwork.query_batch
+# * concurrent requests are coalesced into one batch for up to max_delay_ms or max_batch_size records
+# * the batch runs as one forward pass in an executor, the results are fanned back out to the callers
+import asyncio
+import collections
+import concurrent.futures
+import json
+
+import numpy
+
+from nn import neuralNetwork
+
+
+class BatchingServer:
+    def __init__(
+        self,
+        network: neuralNetwork,
+        max_batch_size: int = 64,
+        max_delay_ms: float = 2.0,
+        executor: concurrent.futures.Executor | None = None,
+    ) -> None:
+        self.network = network
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000.0
+        # ! one thread: a single forward pass at a time, BLAS already uses all cores for it
+        # ! a given executor belongs to the caller and is not shut down by stop()
+        self._owns_executor = executor is None
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self._batcher = None
+        # requests of the batch that is running in the executor
+        self._in_flight = []
+        # metrics
+        self.batch_sizes = collections.Counter()
+        # requests still queued when a batch starts, in power-of-two buckets: 0, 1, 2-3, 4-7, ...
+        self.queue_depths = collections.Counter()
+        self.max_queue_depth = 0
+        self.requests = 0
+
+    async def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        # ! queued and in-flight requests would otherwise wait forever
+        pending = self._in_flight
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        error = RuntimeError("BatchingServer stopped")
+        for _, result in pending:
+            if not result.done():
+                result.set_exception(error)
+        self._in_flight = []
+        self.queue = None
+        if self._owns_executor:
+            self.executor.shutdown(wait=True)
+
+    async def __aenter__(self) -> "BatchingServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+    async def query(self, inputs) -> numpy.ndarray:
+        # * one record in, its (onodes,) outputs back, batched with all concurrent requests
+        if self.queue is None:
+            raise RuntimeError("BatchingServer is not running")
+        record = numpy.asarray(inputs, dtype=self.network.dtype).reshape(self.network.inodes)
+        result = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((record, result))
+        self.requests += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await result
+
+    def stats(self) -> dict:
+        batches = sum(self.batch_sizes.values())
+        batched_requests = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            "requests": self.requests,
+            "batches": batches,
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "max_queue_depth": self.max_queue_depth,
+            "queue_depth_histogram": dict(sorted(self.queue_depths.items())),
+            "mean_batch_size": batched_requests / batches if batches else 0.0,
+            "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+        }
+
+    async def _collect(self) -> list:
+        # wait for the first request, then for more until the batch is full or max_delay is over
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            try:
+                # requests that are already waiting are taken without a timeout
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # callers that gave up (cancelled) do not need a forward pass
+            batch = [(record, result) for record, result in batch if not result.done()]
+            if not batch:
+                continue
+            self.batch_sizes[len(batch)] += 1
+            depth = self.queue.qsize()
+            self.queue_depths[1 << (depth.bit_length() - 1) if depth else 0] += 1
+            inputs = numpy.stack([record for record, _ in batch])
+            self._in_flight = batch
+            try:
+                outputs = await loop.run_in_executor(self.executor, self.network.query_batch, inputs)
+            except Exception as error:
+                self._in_flight = []
+                for _, result in batch:
+                    if not result.done():
+                        result.set_exception(error)
+                continue
+            # ! not in a finally: on cancellation stop() still needs the batch to fail its requests
+            self._in_flight = []
+            for (_, result), output in zip(batch, outputs):
+                if not result.done():
+                    result.set_result(output)
+
+
+async def serve(server: BatchingServer, host: str = "127.0.0.1", port: int = 8765) -> asyncio.Server:
+    # * local socket: one json object per line, {"inputs": [...]} -> {"outputs": [...]} or {"stats": true} -> stats
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    if request.get("stats"):
+                        response = server.stats()
+                    else:
+                        response = {"outputs": (await server.query(request["inputs"])).tolist()}
+                except (ValueError, KeyError, RuntimeError) as error:
+                    response = {"error": str(error)}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+if __name__ == "__main__":
+    from mnist_data_set import load_data, scale_inputs
+
+    async def main() -> None:
+        n = neuralNetwork(784, 200, 10, 0.1, dtype=numpy.float32)
+        _, pixels = load_data("mnist_dataset/mnist_test_10.csv")
+        inputs = scale_inputs(pixels, dtype=numpy.float32)
+        async with BatchingServer(n, max_batch_size=64, max_delay_ms=2.0) as server:
+            # * 1000 concurrent requests, answered with a few batched forward passes
+            outputs = await asyncio.gather(*(server.query(inputs[i % len(inputs)]) for i in range(1000)))
+            print(f"answered {len(outputs)} requests")
+            print(server.stats())
+
+    asyncio.run(main())
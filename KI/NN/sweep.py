@@ -0,0 +1,178 @@
+# parallel hyperparameter sweep for neuralNetwork, one configuration per task in a process pool
+# * the csv files are parsed once, the scaled dataset lives in shared memory and every worker attaches to it
+# * grid search (every combination) or random search (samples drawn from lists and (low, high) ranges)
+# * a validation split of the training data drives early stopping and the ranking, the test csv is only reported
+# * configurations far behind the best validation accuracy seen at the same epoch are stopped early
+# * the results are written as a leaderboard, best validation accuracy first
+#
+# python sweep.py --hidden-nodes 50 100 200 --learning-rate 0.05 0.1 0.2 --epochs 5 --output leaderboard
+# python sweep.py --search random --samples 50 --hidden-nodes 50 500 --learning-rate 0.01 0.5 --output leaderboard
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy
+
+from mnist_data_set import load_data, make_targets, scale_inputs
+from nn import evaluate, neuralNetwork
+from parallel_trainer import SharedArray, pin_blas_threads, spawn_pool
+
+
+def grid(space: dict) -> list:
+    # every combination of the listed values
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+
+def random_search(space: dict, samples: int, seed: int = 0) -> list:
+    # * a list is sampled from, a (low, high) tuple is a uniform range: int if both bounds are ints
+    # ! float ranges are sampled log-uniformly, learning rates spread over orders of magnitude
+    rng = numpy.random.default_rng(seed)
+    configs = []
+    for _ in range(samples):
+        config = {}
+        for name, values in space.items():
+            if isinstance(values, tuple):
+                low, high = values
+                if isinstance(low, int) and isinstance(high, int):
+                    config[name] = int(rng.integers(low, high + 1))
+                else:
+                    config[name] = float(numpy.exp(rng.uniform(numpy.log(low), numpy.log(high))))
+            else:
+                config[name] = values[rng.integers(len(values))]
+        configs.append(config)
+    return configs
+
+
+# * per-process state of a worker, filled by _init_worker
+_worker = {}
+
+
+def _init_worker(specs: dict, settings: dict) -> None:
+    _worker["limits"] = pin_blas_threads(settings["blas_threads"])
+    _worker.update(shared={key: SharedArray.attach(spec) for key, spec in specs.items()}, settings=settings)
+
+
+def _run_config(task: tuple) -> dict:
+    index, config = task
+    shared = _worker["shared"]
+    settings = _worker["settings"]
+    inputs = shared["inputs"].array
+    targets = shared["targets"].array
+    # best validation accuracy of all workers after each epoch, updated without locks: a stale value only delays a stop
+    best = shared["best"].array
+
+    numpy.random.seed(settings["seed"] + index)
+    n = neuralNetwork(inputs.shape[1], config["hidden_nodes"], targets.shape[1], config["learning_rate"], dtype=inputs.dtype)
+    start = time.perf_counter()
+    history = []
+    test_accuracy = None
+    stopped_early = False
+    for e in range(config["epochs"]):
+        n.train_batch(inputs, targets, batch_size=config.get("batch_size", settings["batch_size"]))
+        # ! pruning and ranking only see the validation split, the test set is reported, never used to choose
+        accuracy = evaluate(n, shared["validation_inputs"].array, shared["validation_labels"].array)["accuracy"]
+        if not history or accuracy > max(history):
+            test_accuracy = evaluate(n, shared["test_inputs"].array, shared["test_labels"].array)["accuracy"]
+        history.append(accuracy)
+        best[e] = max(best[e], accuracy)
+        if e + 1 >= settings["min_epochs"] and accuracy < settings["prune_ratio"] * best[e]:
+            stopped_early = True
+            break
+    return {
+        **config,
+        "validation_accuracy": max(history),
+        # test accuracy of the epoch with the best validation accuracy
+        "test_accuracy": test_accuracy,
+        "best_epoch": int(numpy.argmax(history)),
+        "epochs_run": len(history),
+        "stopped_early": stopped_early,
+        "seconds": time.perf_counter() - start,
+        "history": history,
+    }
+
+
+def sweep(
+    configs: list,
+    training_data: str = "mnist_dataset/mnist_train_100.csv",
+    test_data: str = "mnist_dataset/mnist_test_10.csv",
+    workers: int | None = None,
+    dtype=numpy.float32,
+    batch_size: int = 10,
+    validation_fraction: float = 0.2,  # ! held out of the training data for pruning and ranking
+    min_epochs: int = 2,  # ! no configuration is stopped before it trained this many epochs
+    prune_ratio: float = 0.5,  # ! stop when the validation accuracy is below prune_ratio * best at the same epoch
+    blas_threads: int = 1,
+    seed: int = 0,
+) -> list:
+    # * configs: dicts with hidden_nodes, learning_rate, epochs (and optionally batch_size), returns the leaderboard
+    labels, pixels = load_data(training_data)
+    test_labels, test_pixels = load_data(test_data)
+    # the same shuffled split for every configuration
+    order = numpy.random.default_rng(seed).permutation(len(labels))
+    validation, training = order[:int(len(labels) * validation_fraction)], order[int(len(labels) * validation_fraction):]
+    shared = {
+        "inputs": SharedArray.copy_of(scale_inputs(pixels[training], dtype=dtype)),
+        "targets": SharedArray.copy_of(make_targets(labels[training], dtype=dtype)),
+        "validation_inputs": SharedArray.copy_of(scale_inputs(pixels[validation], dtype=dtype)),
+        "validation_labels": SharedArray.copy_of(numpy.asarray(labels[validation], dtype=numpy.intp)),
+        "test_inputs": SharedArray.copy_of(scale_inputs(test_pixels, dtype=dtype)),
+        "test_labels": SharedArray.copy_of(numpy.asarray(test_labels, dtype=numpy.intp)),
+        "best": SharedArray.copy_of(numpy.zeros(max(config["epochs"] for config in configs))),
+    }
+    settings = {"batch_size": batch_size, "min_epochs": min_epochs, "prune_ratio": prune_ratio, "blas_threads": blas_threads, "seed": seed}
+    workers = min(workers or os.cpu_count() or 1, len(configs))
+
+    results = []
+    try:
+        with spawn_pool(workers, blas_threads, _init_worker, ({key: array.spec() for key, array in shared.items()}, settings)) as pool:
+            for result in pool.imap_unordered(_run_config, enumerate(configs)):
+                print(json.dumps({key: value for key, value in result.items() if key != "history"}), file=sys.stderr)
+                results.append(result)
+    finally:
+        for array in shared.values():
+            array.unlink()
+    return sorted(results, key=lambda result: (-result["validation_accuracy"], result["seconds"]))
+
+
+def write_leaderboard(results: list, path: str) -> None:
+    # <path>.json with the accuracy history per epoch, <path>.csv without it
+    with open(path + ".json", "w") as f:
+        json.dump(results, f, indent=2)
+    columns = [key for key in results[0] if key != "history"] if results else []
+    with open(path + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="hyperparameter sweep for nn.neuralNetwork")
+    parser.add_argument("--training-data", default="mnist_dataset/mnist_train_100.csv")
+    parser.add_argument("--test-data", default="mnist_dataset/mnist_test_10.csv")
+    parser.add_argument("--search", choices=["grid", "random"], default="grid")
+    parser.add_argument("--samples", type=int, default=50, help="configurations for --search random")
+    parser.add_argument("--hidden-nodes", type=int, nargs="+", default=[100, 200])
+    parser.add_argument("--learning-rate", type=float, nargs="+", default=[0.1, 0.2])
+    parser.add_argument("--epochs", type=int, nargs="+", default=[5])
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--validation-fraction", type=float, default=0.2)
+    parser.add_argument("--min-epochs", type=int, default=2)
+    parser.add_argument("--prune-ratio", type=float, default=0.5)
+    parser.add_argument("--output", default="leaderboard", help="writes <output>.csv and <output>.json")
+    args = parser.parse_args()
+
+    space = {"hidden_nodes": args.hidden_nodes, "learning_rate": args.learning_rate, "epochs": args.epochs}
+    if args.search == "grid":
+        configs = grid(space)
+    else:
+        # * two values are a range, anything else a list to choose from
+        configs = random_search({name: tuple(values) if len(values) == 2 else values for name, values in space.items()}, args.samples)
+    results = sweep(configs, args.training_data, args.test_data, workers=args.workers, validation_fraction=args.validation_fraction, min_epochs=args.min_epochs, prune_ratio=args.prune_ratio)
+    write_leaderboard(results, args.output)
+    for result in results[:10]:
+        print(f"validation {result['validation_accuracy']:.3f} test {result['test_accuracy']:.3f}  hidden_nodes={result['hidden_nodes']} learning_rate={result['learning_rate']:.4g} epochs={result['epochs_run']}/{result['epochs']}{' (stopped)' if result['stopped_early'] else ''}")
@@ -1,85 +1,68 @@
 # this script is about creating neuro from scratch
 # @author: Xiekang
-import math
 import sys
-import random
+import numpy
 
-# ! placeholder -> do it later
-Matrix = str
-ActivationFunction = str
+# * KI/ is on sys.path when this script runs, the activation engine lives in NN/
+from NN.activations import ActivationFunction, get_activation
+
+Matrix = numpy.ndarray
 
 
 def neuro(
     neuro_input: float, activation_function: str = "linear", parameter: float = 0.0
 ) -> float:
-    match activation_function.lower():
-        case "linear":
-            return neuro_input
-        case "binary":
-            return 0 if neuro_input < 0 else 1
-        case "sigmoid":
-            return 1 / (1 + math.exp(-neuro_input))
-        case "tanh":
-            return math.tanh(neuro_input)
-        case "arctan":
-            return 1 / math.tan(neuro_input)
-        case "relu":
-            return 0 if neuro_input < 0 else neuro_input
-        case "prelu":
-            prelu = lambda p, x: p * x
-            return prelu(parameter, neuro_input) if neuro_input < 0 else neuro_input
-        case "elu":
-            elu = lambda p, x: p * (math.exp(x) - 1)
-            return elu(parameter, neuro_input) if neuro_input < 0 else neuro_input
-        case "softplus":
-            return math.log1p(1 + math.exp(neuro_input))
-        case _:
-            print("Does not support given activation function", file=sys.stderr)
-            """for _ in range(10):
-                with open("text.txt", "a") as f:
-                    print("bsljdfaslkfjlsjfdsklajfslf", file=f)"""
-    return -100.0
+    # * the name is resolved once per (name, parameter) and cached, see get_activation
+    try:
+        activation = get_activation(activation_function, parameter)
+    except ValueError:
+        print("Does not support given activation function", file=sys.stderr)
+        return -100.0
+    return float(activation(numpy.float64(neuro_input)))
+
+
+def make_weights(
+    layer_sizes: list[int], weight_split_method: str = "evenly", seed: int | None = None
+) -> list[Matrix]:
+    # * one (next layer, previous layer) matrix per layer transition
+    # * every column holds the weights of one neuro to the next layer and sums up to 1
+    rng = numpy.random.default_rng(seed)
+    weights = []
+    for previous_layer, next_layer in zip(layer_sizes[:-1], layer_sizes[1:]):
+        if weight_split_method == "evenly":
+            weight = numpy.full((next_layer, previous_layer), 1 / next_layer)
+        elif weight_split_method == "randomly":
+            weight = rng.random((next_layer, previous_layer))
+            weight /= weight.sum(axis=0)
+        else:
+            raise RuntimeError("no support weight split method!")
+        weights.append(weight)
+    return weights
 
 
 def neural_network(
-    input_values: list,
-    hidden_layers_with_neuro_number: list,  # ! first focus on 1 hidden layer --> [3] --> 1 hidden layer + 3 neuros
+    input_values: list | Matrix,  # ! one record, or a (N, inputs) batch of records
+    hidden_layers_with_neuro_number: list,  # ! [3] --> 1 hidden layer + 3 neuros
     # ! [3, 2] --> 2 hidden layers --> 3 neuros, 2 neuros
     neuro_output_layer: int = 1,  # ! based on problem
     weight_split_method: str = "evenly", # ! Sepration of the weights
-    **kwargs # ! unlimted parameters (key = value)
-) -> list[float]:
-    number_of_neuro_in_input_layer = len(input_values)
-    weights = []
-    # * define weights based on each neuro
-    for _ in range(number_of_neuro_in_input_layer):
-        weight = []
-        for hidden_layers_input in hidden_layers_with_neuro_number:
-            if weight_split_method == "evenly":
-                weight = [1 / hidden_layers_input] * hidden_layers_input
-            elif weight_split_method == "randomly":
-                weight = [random.random() for _ in range(hidden_layers_input)]
-                s = sum(weight)
-                weight = [w / s for w in weight]
-            else:
-                raise RuntimeError("no support weight split method!")
-        weights.append(weight)
-
-    # * matrix multiple
-    hidden_layers_input_values = []
-    for index in range(len(weights[0])):
-        hidden_layers_input_value = []
-        for w in weights:
-            hidden_layers_input_value.append(w[index])
-        hidden_layers_input_values.append(
-            sum([i * w for i, w in zip(input_values, hidden_layers_input_value)])
-        )
+    **kwargs # ! unlimted parameters (key = value): activation_function, parameter, seed
+) -> list[float] | Matrix:
+    inputs = numpy.asarray(input_values, dtype=float)
+    batched = inputs.ndim == 2
+    # * one record per row
+    signals = numpy.atleast_2d(inputs)
+    layer_sizes = [signals.shape[1], *hidden_layers_with_neuro_number, neuro_output_layer]
+    weights = make_weights(layer_sizes, weight_split_method, kwargs.get("seed"))
 
-    # * output
-    hidden_layers_output_values = []
-    for value in hidden_layers_input_values:
-        hidden_layers_output_values.append(neuro(value))
-    return hidden_layers_output_values
+    activation: ActivationFunction = get_activation(
+        kwargs.get("activation_function", "linear"), kwargs.get("parameter", 0.0)
+    )
+    # * matrix multiple: one matrix product and one activation call per layer
+    for weight in weights:
+        signals = signals @ weight.T
+        activation(signals, out=signals)
+    return signals if batched else signals[0].tolist()
 
 
 if __name__ == "__main__":
@@ -96,3 +79,5 @@ if __name__ == "__main__":
     # print(neuro(0.5, "bbbbbbbb"))
     # print(sys.float_info)
     print(neural_network([0.5, 0.5], [2], weight_split_method="randomly"))
+    # * arbitrary depth and a batch of records
+    print(neural_network(numpy.random.rand(4, 3), [3, 2], neuro_output_layer=2, activation_function="sigmoid"))
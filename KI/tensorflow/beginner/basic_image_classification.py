@@ -1,4 +1,8 @@
+import concurrent.futures
 import logging
+import multiprocessing
+import resource
+import sys
 import tensorflow as tf
 import numpy as np
 import matplotlib.pyplot as plt
@@ -17,9 +21,32 @@ class_names = [
 ]
 
 
-def get_data(use_own_model: bool = False):
+def _scale_batch(images, labels):
+    # * one vectorized op per batch: uint8 -> float32 in 0.01 - 1.0, plus a channels dimension
+    images = tf.cast(images, tf.float32) * (0.99 / 255.0) + 0.01
+    return images[..., tf.newaxis], labels
+
+
+def get_data(use_own_model: bool = False, lazy_normalization: bool = False):
     fashion_mnist = tf.keras.datasets.fashion_mnist
     (train_images, train_labels), (test_images, test_labes) = fashion_mnist.load_data()
+    if use_own_model and lazy_normalization:
+        # ! the images stay uint8 (47 MB instead of ~376 MB float64 plus a float32 copy),
+        # ! they are scaled batch by batch right after batching
+        train_ds = (
+            tf.data.Dataset.from_tensor_slices((train_images, train_labels))
+            .shuffle(10000)
+            .batch(32)
+            .map(_scale_batch, num_parallel_calls=tf.data.AUTOTUNE)
+            .prefetch(tf.data.AUTOTUNE)
+        )
+        test_ds = (
+            tf.data.Dataset.from_tensor_slices((test_images, test_labes))
+            .batch(32)
+            .map(_scale_batch, num_parallel_calls=tf.data.AUTOTUNE)
+            .prefetch(tf.data.AUTOTUNE)
+        )
+        return train_ds, test_ds
     if train_images[0].any() >= 1:
         print("the image's pixel need to be rescaled.")
         # * according to NN from scratch, you should add a small number to the dataset to avoid 0.
@@ -37,6 +64,28 @@ def get_data(use_own_model: bool = False):
         return train_images, train_labels, test_images, test_labes
 
 
+def _peak_memory(lazy_normalization: bool) -> int:
+    # peak RSS in bytes of get_data plus one pass over both datasets
+    train_ds, test_ds = get_data(True, lazy_normalization=lazy_normalization)
+    for dataset in (train_ds, test_ds):
+        for _ in dataset:
+            pass
+    # ! ru_maxrss is in kilobytes on linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def memory_report() -> dict:
+    # * each mode in a fresh process, so the peaks are not shared
+    context = multiprocessing.get_context("spawn")
+    report = {}
+    for lazy_normalization in (False, True):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            report["lazy" if lazy_normalization else "eager"] = pool.submit(_peak_memory, lazy_normalization).result()
+    report["saved"] = report["eager"] - report["lazy"]
+    return report
+
+
 def show_image(images: list, labels: list, predictions: list) -> None:
     num_rows = 5
     num_cols = 3
@@ -199,8 +248,13 @@ if __name__ == "__main__":
 
     # show_image(x_test, y_test, predictions)
 
+    # * peak memory of the float64 preprocessing versus uint8 images scaled per batch
+    if "--memory-report" in sys.argv:
+        report = memory_report()
+        print(f"peak RSS: eager {report['eager'] / 2**20:.0f} MiB, lazy {report['lazy'] / 2**20:.0f} MiB, saved {report['saved'] / 2**20:.0f} MiB")
+
     # * exp way
-    train_ds, test_ds = get_data(True) # type: ignore
+    train_ds, test_ds = get_data(True, lazy_normalization=True) # type: ignore
     model = MyModel(input_shape=(28, 28))
     training = MyTrainingSteps(
         train=train_ds,
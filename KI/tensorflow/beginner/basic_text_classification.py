@@ -1,4 +1,5 @@
 import tensorflow as tf
+import numpy as np
 import os
 import shutil
 import re
@@ -19,95 +20,243 @@ def vectorize_text(text, label):
     return vectorize_layer(text), label
 
 
-if __name__ == "__main__":
-    url = "https://ai.stanford.edu/~amaas/data/sentiment/aclImdb_v1.tar.gz"
-    dataset = tf.keras.utils.get_file(
-        "aclImdb_v1", url, untar=True, cache_dir=".", cache_subdir=""
-    )
-    dataset_dir = os.path.join(os.path.dirname(dataset), "aclImdb")
-    train_dir = os.path.join(dataset_dir, "train")
-
-    # file structure for call text_dataset_from_directory
-    # root/
-    #   class_a/
-    #       txt
-    #   class_b/
-    #       txt
-    remove_dir = os.path.join(train_dir, "unsup")
-    shutil.rmtree(remove_dir)
+# * one-off conversion: every split is packed into a few GZIP TFRecord shards of already tokenized reviews
+# * training then reads a handful of big files in parallel instead of 25k small ones and skips the standardization
+SHARD_DIR = "aclImdb_shards"
+NUM_SHARDS = 4
 
-    batch_size = 32
-    seed = 42
-    raw_train_ds = tf.keras.utils.text_dataset_from_directory(
-        "aclImdb/train",
-        batch_size=batch_size,
-        validation_split=0.2,
-        subset="training",
-        seed=seed,
-    )
 
-    # Example for take data
-    for text_batch, label_batch in raw_train_ds.take(1):
-        for i in range(3):
-            print("Review: ", text_batch.numpy()[i])
-            print("Label", label_batch.numpy()[i])
-
-    # When using the "validation_split" and "subset" arguments, make sure to either specify a random seed, or to pass shuffle=False, so that the validation and training
-    # splits have no overlap.
-    raw_val_ds = tf.keras.utils.text_dataset_from_directory(
-        "aclImdb/train",
-        batch_size=batch_size,
-        validation_split=0.2,
-        subset="validation",
-        seed=seed,
+def convert_to_shards(raw_ds: tf.data.Dataset, layer, split: str, shard_dir: str = SHARD_DIR, num_shards: int = NUM_SHARDS) -> list:
+    # raw (text, label) batches -> <shard_dir>/<split>-0000i-of-0000n.tfrecord.gz, round robin over the shards
+    # * every record keeps the raw review next to its tokens, export_model is evaluated on the raw strings
+    os.makedirs(shard_dir, exist_ok=True)
+    paths = [os.path.join(shard_dir, f"{split}-{i:05d}-of-{num_shards:05d}.tfrecord.gz") for i in range(num_shards)]
+    options = tf.io.TFRecordOptions(compression_type="GZIP")
+    writers = [tf.io.TFRecordWriter(path + ".tmp", options) for path in paths]
+    tokenized = raw_ds.map(lambda text, label: (text, layer(text), label), num_parallel_calls=tf.data.AUTOTUNE)
+    record = 0
+    for texts, sequences, labels in tokenized.as_numpy_iterator():
+        for text, sequence, label in zip(texts, sequences, labels):
+            # ! 0 is the padding token, only the real tokens are stored
+            example = tf.train.Example(features=tf.train.Features(feature={
+                "text": tf.train.Feature(bytes_list=tf.train.BytesList(value=[text])),
+                "tokens": tf.train.Feature(int64_list=tf.train.Int64List(value=sequence[sequence != 0])),
+                "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+            }))
+            writers[record % num_shards].write(example.SerializeToString())
+            record += 1
+    # ! the shards only get their final names once all of them are complete
+    for writer, path in zip(writers, paths):
+        writer.close()
+        os.replace(path + ".tmp", path)
+    return paths
+
+
+def save_vocabulary(layer, shard_dir: str = SHARD_DIR) -> None:
+    # the token ids in the shards only make sense together with this vocabulary
+    # ! written last, its presence marks a complete conversion
+    with open(os.path.join(shard_dir, "vocabulary.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(layer.get_vocabulary()))
+
+
+def load_vocabulary(shard_dir: str = SHARD_DIR) -> list:
+    with open(os.path.join(shard_dir, "vocabulary.txt"), "r", encoding="utf-8") as f:
+        return f.read().split("\n")
+
+
+def _parse_batch(serialized, sequence_length: int, raw: bool):
+    # * one parse_example call per batch instead of one per review
+    if raw:
+        features = tf.io.parse_example(serialized, {
+            "text": tf.io.FixedLenFeature([], tf.string),
+            "label": tf.io.FixedLenFeature([], tf.int64),
+        })
+        return features["text"], tf.cast(features["label"], tf.int32)
+    features = tf.io.parse_example(serialized, {
+        "tokens": tf.io.VarLenFeature(tf.int64),
+        "label": tf.io.FixedLenFeature([], tf.int64),
+    })
+    tokens = tf.sparse.to_dense(features["tokens"])[:, :sequence_length]
+    tokens = tf.pad(tokens, [[0, 0], [0, sequence_length - tf.shape(tokens)[1]]])
+    tokens.set_shape([None, sequence_length])
+    return tokens, tf.cast(features["label"], tf.int32)
+
+
+def load_shards(split: str, batch_size: int = 32, sequence_length: int = 250, shuffle: bool = False, raw: bool = False, shard_dir: str = SHARD_DIR) -> tf.data.Dataset:
+    # (tokens padded to sequence_length, label) batches, or (raw text, label) batches with raw=True
+    files = tf.data.Dataset.list_files(os.path.join(shard_dir, f"{split}-*.tfrecord.gz"), shuffle=shuffle)
+    dataset = files.interleave(
+        lambda path: tf.data.TFRecordDataset(path, compression_type="GZIP"),
+        cycle_length=tf.data.AUTOTUNE,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=not shuffle,
     )
-    raw_test_ds = tf.keras.utils.text_dataset_from_directory(
-        "aclImdb/test", batch_size=batch_size
+    if shuffle:
+        dataset = dataset.shuffle(10000)
+    return (
+        dataset.batch(batch_size)
+        .map(lambda serialized: _parse_batch(serialized, sequence_length, raw), num_parallel_calls=tf.data.AUTOTUNE)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+
+
+class MaskedAveragePooling1D(tf.keras.layers.Layer):
+    # GlobalAveragePooling1D over the unmasked positions that stays finite for a row without any token
+    # ! an empty review (or one of punctuation only) is fully masked, the plain layer divides 0 by a mask sum of 0 -> nan
+    def call(self, inputs, mask=None):
+        if mask is None:
+            return tf.reduce_mean(inputs, axis=1)
+        mask = tf.cast(mask, inputs.dtype)[:, :, None]
+        # * no tokens: a zero vector, the prediction falls back to the bias of the Dense layer
+        return tf.reduce_sum(inputs * mask, axis=1) / tf.maximum(tf.reduce_sum(mask, axis=1), 1.0)
+
+    def compute_mask(self, inputs, mask=None):
+        return None
+
+
+# * serving / eval: reviews are grouped by length and padded only to their bucket boundary, not to sequence_length
+# ! needs Embedding(mask_zero=True), so MaskedAveragePooling1D averages over the real tokens only
+def predict_bucketed(model, layer, texts, sequence_length: int = 250, boundaries: tuple = (16, 32, 64, 128), batch_size: int = 32):
+    # layer: TextVectorization with the training vocabulary, ragged=True and no output_sequence_length
+    # returns the probabilities in the order of texts and the token positions with and without padding
+    boundaries = [boundary for boundary in boundaries if boundary < sequence_length] + [sequence_length]
+    dataset = (
+        tf.data.Dataset.from_tensor_slices(texts)
+        .batch(batch_size)
+        .map(layer, num_parallel_calls=tf.data.AUTOTUNE)
+        .unbatch()
+        .map(lambda tokens: tokens[:sequence_length], num_parallel_calls=tf.data.AUTOTUNE)
+        .enumerate()
+        # ! pad_to_bucket_boundary pads to boundary - 1, hence the + 1
+        .bucket_by_sequence_length(
+            element_length_func=lambda index, tokens: tf.shape(tokens)[0],
+            bucket_boundaries=[boundary + 1 for boundary in boundaries],
+            bucket_batch_sizes=[batch_size] * (len(boundaries) + 1),
+            pad_to_bucket_boundary=True,
+        )
+        .prefetch(tf.data.AUTOTUNE)
     )
 
-    # Prepare the dataset for training
-    # * info
-    # * Standardization: removing punctuation or HTML elements
-    # * Tokenization: splitting strings into tokens
-    # * Vectorization: converting tokens into numbers
+    # * the input signature leaves the length open: one trace for all buckets
+    @tf.function(input_signature=[tf.TensorSpec([None, None], tf.int64)])
+    def score(tokens):
+        return tf.sigmoid(model(tokens, training=False))[:, 0]
+
+    predictions = np.empty(len(texts), dtype=np.float32)
+    positions = {"tokens": 0, "padded": 0, "fixed": len(texts) * sequence_length}
+    for indices, tokens in dataset:
+        predictions[indices.numpy()] = score(tokens).numpy()
+        positions["tokens"] += int(tf.math.count_nonzero(tokens))
+        positions["padded"] += int(tf.size(tokens))
+    return predictions, positions
+
+
+if __name__ == "__main__":
+    batch_size = 32
+    seed = 42
     max_features = 10000
     sequence_length = 250
+
+    if not os.path.exists(os.path.join(SHARD_DIR, "vocabulary.txt")):
+        url = "https://ai.stanford.edu/~amaas/data/sentiment/aclImdb_v1.tar.gz"
+        dataset = tf.keras.utils.get_file(
+            "aclImdb_v1", url, untar=True, cache_dir=".", cache_subdir=""
+        )
+        dataset_dir = os.path.join(os.path.dirname(dataset), "aclImdb")
+        train_dir = os.path.join(dataset_dir, "train")
+
+        # file structure for call text_dataset_from_directory
+        # root/
+        #   class_a/
+        #       txt
+        #   class_b/
+        #       txt
+        remove_dir = os.path.join(train_dir, "unsup")
+        # ! already gone when an earlier conversion was interrupted
+        shutil.rmtree(remove_dir, ignore_errors=True)
+
+        raw_train_ds = tf.keras.utils.text_dataset_from_directory(
+            "aclImdb/train",
+            batch_size=batch_size,
+            validation_split=0.2,
+            subset="training",
+            seed=seed,
+        )
+
+        # Example for take data
+        for text_batch, label_batch in raw_train_ds.take(1):
+            for i in range(3):
+                print("Review: ", text_batch.numpy()[i])
+                print("Label", label_batch.numpy()[i])
+
+        # When using the "validation_split" and "subset" arguments, make sure to either specify a random seed, or to pass shuffle=False, so that the validation and training
+        # splits have no overlap.
+        raw_val_ds = tf.keras.utils.text_dataset_from_directory(
+            "aclImdb/train",
+            batch_size=batch_size,
+            validation_split=0.2,
+            subset="validation",
+            seed=seed,
+        )
+        raw_test_ds = tf.keras.utils.text_dataset_from_directory(
+            "aclImdb/test", batch_size=batch_size
+        )
+
+        # Prepare the dataset for training
+        # * info
+        # * Standardization: removing punctuation or HTML elements
+        # * Tokenization: splitting strings into tokens
+        # * Vectorization: converting tokens into numbers
+        vectorize_layer = tf.keras.layers.TextVectorization(
+            standardize=custom_standardization,
+            max_tokens=max_features,
+            output_mode="int",
+            output_sequence_length=sequence_length,
+        )
+        # Next, you will call adapt to fit the state of the preprocessing layer to the dataset.
+        # This will cause the model to build an index of strings to integers.
+        # * It's important to only use your training data when calling adapt, using the test set would leak information
+        # Make a text-only dataset without labels, then call adapt
+        train_text = raw_train_ds.map(lambda x, y: x, num_parallel_calls=tf.data.AUTOTUNE)
+        vectorize_layer.adapt(train_text)
+
+        # retrieve a batch of 32 reviews and labels from the dataset
+        text_batch, label_batch = next(iter(raw_train_ds))
+        first_review, first_label = text_batch[0], label_batch[0]
+        print("Review", first_review)
+        print("Label", raw_train_ds.class_names[first_label])
+        print("Vectorized review", vectorize_text(first_review, first_label))
+        # You can lookup the token (string) that each integer corresponds to by calling .get_vocabulary() on the layer
+        print("1287 ---> ", vectorize_layer.get_vocabulary()[1287])
+        print(" 313 --> ", vectorize_layer.get_vocabulary()[313])
+        print("Vocabulary size: {}".format(len(vectorize_layer.get_vocabulary())))
+
+        # * tokenized once, the splits are read from the shards from now on
+        convert_to_shards(raw_train_ds, vectorize_layer, "train")
+        convert_to_shards(raw_val_ds, vectorize_layer, "validation")
+        convert_to_shards(raw_test_ds, vectorize_layer, "test")
+        save_vocabulary(vectorize_layer)
+
+    # * the vectorization layer for export_model, rebuilt from the vocabulary of the shards
     vectorize_layer = tf.keras.layers.TextVectorization(
         standardize=custom_standardization,
         max_tokens=max_features,
         output_mode="int",
         output_sequence_length=sequence_length,
+        vocabulary=load_vocabulary(),
     )
-    # Next, you will call adapt to fit the state of the preprocessing layer to the dataset.
-    # This will cause the model to build an index of strings to integers.
-    # * It's important to only use your training data when calling adapt, using the test set would leak information
-    # Make a text-only dataset without labels, then call adapt
-    train_text = raw_train_ds.map(lambda x, y: x)
-    vectorize_layer.adapt(train_text)
-
-    # retrieve a batch of 32 reviews and labels from the dataset
-    text_batch, label_batch = next(iter(raw_train_ds))
-    first_review, first_label = text_batch[0], label_batch[0]
-    print("Review", first_review)
-    print("Label", raw_train_ds.class_names[first_label])
-    print("Vectorized review", vectorize_text(first_review, first_label))
-    # You can lookup the token (string) that each integer corresponds to by calling .get_vocabulary() on the layer
-    print("1287 ---> ", vectorize_layer.get_vocabulary()[1287])
-    print(" 313 --> ", vectorize_layer.get_vocabulary()[313])
-    print("Vocabulary size: {}".format(len(vectorize_layer.get_vocabulary())))
-    train_ds = raw_train_ds.map(vectorize_text)
-    val_ds = raw_val_ds.map(vectorize_text)
-    test_ds = raw_test_ds.map(vectorize_text)
+    # * raw strings for export_model, also read from the shards instead of the 25k small files
+    raw_test_ds = load_shards("test", batch_size, raw=True)
 
     # * These are two important methods you should use when loading data to make sure that I/O does not become blocking
     # * .cache() keeps data in memory after it's loaded off disk. This will ensure the dataset does not become a bottleneck while training your model.
     # * If your dataset is too large to fit into memory, you can also use this method to create a performant on-disk cache, which is more efficient to read
     # * than many small files
     # * .prefetch() overlaps data preprocessing and model execution while training
-    AUTOTUNE = tf.data.AUTOTUNE
-    train_ds = train_ds.cache().prefetch(buffer_size=AUTOTUNE)
-    val_ds = val_ds.cache().prefetch(buffer_size=AUTOTUNE)
-    test_ds = test_ds.cache().prefetch(buffer_size=AUTOTUNE)
+    # ! the shards are that on-disk cache: read with interleaved parallel I/O, parsed batch by batch and prefetched, see load_shards
+    train_ds = load_shards("train", batch_size, sequence_length, shuffle=True)
+    val_ds = load_shards("validation", batch_size, sequence_length)
+    test_ds = load_shards("test", batch_size, sequence_length)
 
     # Create the model
     # TODO: Embedding layer
@@ -115,9 +264,10 @@ if __name__ == "__main__":
     embedding_dim = 16
     model = tf.keras.Sequential(
         [
-            tf.keras.layers.Embedding(max_features + 1, embedding_dim),
+            # ! mask_zero: the padding token 0 is masked, the average ignores it for any padded length
+            tf.keras.layers.Embedding(max_features + 1, embedding_dim, mask_zero=True),
             tf.keras.layers.Dropout(0.2),
-            tf.keras.layers.GlobalAveragePooling1D(),
+            MaskedAveragePooling1D(),
             tf.keras.layers.Dropout(0.2),
             tf.keras.layers.Dense(1),
         ]
@@ -185,4 +335,20 @@ if __name__ == "__main__":
     "The movie was terrible..."
     ]
 
-    print(export_model.predict(examples))
\ No newline at end of file
+    print(export_model.predict(examples))
+
+    # * same vocabulary, no fixed length: every bucket is padded only to its own boundary
+    serving_layer = tf.keras.layers.TextVectorization(
+        standardize=custom_standardization,
+        max_tokens=max_features,
+        output_mode="int",
+        ragged=True,
+        vocabulary=load_vocabulary(),
+    )
+    predictions, positions = predict_bucketed(model, serving_layer, examples, sequence_length)
+    print(predictions)
+    # ! no tokens at all: scored from the bias instead of nan
+    print(predict_bucketed(model, serving_layer, ["", "...!?"], sequence_length)[0], export_model.predict(["", "...!?"]))
+    test_texts = [text for texts, _ in raw_test_ds.as_numpy_iterator() for text in texts]
+    _, positions = predict_bucketed(model, serving_layer, test_texts, sequence_length)
+    print(f"token positions: {positions['tokens']} real, {positions['padded']} bucketed, {positions['fixed']} with fixed length {sequence_length}")
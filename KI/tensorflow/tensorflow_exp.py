@@ -1,21 +1,77 @@
 # a full customized model
 from typing import Union
+import hashlib
+import json
+import os
+import shutil
+import warnings
 import tensorflow as tf
 
 
-def get_data():
-    mnist = tf.keras.datasets.mnist
-    (x_train, y_train), (x_test, y_test) = mnist.load_data()
-    x_train, x_test = x_train / 255.0, x_test / 255.0
+# * the normalized dataset is written once to a sharded on-disk cache, one directory per preprocessing key
+# * later runs stream the shards in parallel instead of loading and normalizing MNIST again
+# ! records are stored in chunks of CHUNK_SIZE: Dataset.load pays a fixed cost per element, per record it was ~4x slower than from_tensor_slices
+# ! uncompressed: ~210 MB on disk instead of ~30 MB with GZIP, but GZIP made the first build 4x and the first epoch 2x slower
+CACHE_DIR = "tf_data_cache"
+NUM_SHARDS = 8
+CHUNK_SIZE = 1000
 
-    # * add a chaneels dimension
-    x_train = x_train[..., tf.newaxis].astype("float32")
-    x_test = x_test[..., tf.newaxis].astype("float32")
 
-    train_ds = (
-        tf.data.Dataset.from_tensor_slices((x_train, y_train)).shuffle(10000).batch(32)
+def _cache_path(split: str, **preprocessing) -> str:
+    # ! every parameter that changes the cached tensors is part of the key, a change writes a new cache
+    key = json.dumps({"dataset": "mnist", "split": split, **preprocessing}, sort_keys=True)
+    return os.path.join(CACHE_DIR, f"mnist-{split}-{hashlib.sha1(key.encode()).hexdigest()[:12]}")
+
+
+def _normalize(images, labels, scale: float):
+    # uint8 -> float32 in the graph, no float64 copy, plus a channels dimension
+    images = tf.cast(images, tf.float32) * scale
+    return images[..., tf.newaxis], labels
+
+
+def _materialize(path: str, images, labels, scale: float, num_shards: int, chunk_size: int) -> None:
+    # * one saved element is a chunk of chunk_size normalized records, normalized with one vectorized op
+    dataset = (
+        tf.data.Dataset.from_tensor_slices((images, labels))
+        .batch(chunk_size)
+        .map(lambda x, y: _normalize(x, y, scale), num_parallel_calls=tf.data.AUTOTUNE)
+        .enumerate()
     )
-    test_ds = tf.data.Dataset.from_tensor_slices((x_test, y_test)).batch(32)
+    # ! written to a temp directory first, an interrupted run never leaves a half cache behind
+    temp_path = path + ".tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    dataset.save(temp_path, shard_func=lambda index, _: index % num_shards)
+    os.replace(temp_path, path)
+
+
+def _load_cached(path: str, shuffle_shards: bool) -> tf.data.Dataset:
+    def read_shards(shards):
+        if shuffle_shards:
+            shards = shards.shuffle(NUM_SHARDS)
+        # * all shards are read in parallel, order across shards does not matter
+        return shards.interleave(lambda shard: shard, cycle_length=tf.data.AUTOTUNE, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+
+    dataset = tf.data.Dataset.load(path, reader_func=read_shards)
+    # drop the index that was only needed for sharding
+    dataset = dataset.map(lambda index, example: example, num_parallel_calls=tf.data.AUTOTUNE)
+    # ! the disk is read once per run: later epochs take the chunks from memory (~190 MB for the train split)
+    return dataset.cache().unbatch()
+
+
+def get_data(batch_size: int = 32, scale: float = 1.0 / 255.0, num_shards: int = NUM_SHARDS, chunk_size: int = CHUNK_SIZE):
+    preprocessing = {"scale": scale, "dtype": "float32", "channels": 1, "chunk_size": chunk_size}
+    paths = {split: _cache_path(split, **preprocessing) for split in ("train", "test")}
+    # ! only the missing splits are written, a run interrupted between the two keeps the finished one
+    missing = [split for split, path in paths.items() if not os.path.isdir(path)]
+    if missing:
+        mnist = tf.keras.datasets.mnist
+        (x_train, y_train), (x_test, y_test) = mnist.load_data()
+        splits = {"train": (x_train, y_train), "test": (x_test, y_test)}
+        for split in missing:
+            _materialize(paths[split], *splits[split], scale, num_shards, chunk_size)
+
+    train_ds = _load_cached(paths["train"], shuffle_shards=True).shuffle(10000).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+    test_ds = _load_cached(paths["test"], shuffle_shards=False).batch(batch_size).prefetch(tf.data.AUTOTUNE)
 
     return train_ds, test_ds
 
@@ -35,17 +91,74 @@ class MyModel(tf.keras.Model):
         return self.d2(inputs)
 
 
-@tf.function
-def train_step(model, images, labels, objective, losses, accuracy, optimizer):
-    with tf.GradientTape() as tape:
-        # ! training=True is only needed if there are layers with different behavior during training vs inference
-        predictions = model(images, training=True)
-        loss = objective(labels, predictions)
-    gradients = tape.gradient(loss, model.trainable_variables)
-    optimizer.apply_gradients(zip(gradients, model.trainable_variables))
-
-    losses(loss)
-    accuracy(labels, predictions)
+class CompiledTrainer:
+    # * runs up to steps_per_call training steps per graph call, instead of one Python dispatch per batch
+    # * model, objective, metrics and optimizer are bound once here, only the iterator is a graph argument
+    # * jit_compile=True compiles the inner step (forward, backward, update) with XLA
+    def __init__(self, model, objective, losses, accuracy, optimizer, steps_per_call: int = 50, jit_compile: bool = False) -> None:
+        self.model = model
+        self.objective = objective
+        self.losses = losses
+        self.accuracy = accuracy
+        self.optimizer = optimizer
+        self.steps_per_call = steps_per_call
+        # traces per function, a second trace means a new graph was built for new argument types or shapes
+        self.traces = {"step": 0, "steps": 0}
+        self._step = tf.function(self._step_function, jit_compile=jit_compile)
+        self._steps = tf.function(self._steps_function)
+        self._built = False
+
+    def _build(self, dataset: tf.data.Dataset) -> None:
+        # ! variables created in the first call make a tf.function trace twice, so model and optimizer
+        # ! create theirs up front and the trace counter only sees real retraces
+        # ! one eager call on a single zero image: model.build(shape) creates no variables for a subclassed model under Keras 3
+        images, _ = dataset.element_spec
+        self.model(tf.zeros((1,) + tuple(images.shape[1:]), images.dtype), training=False)
+        self.optimizer.build(self.model.trainable_variables)
+        self._built = True
+
+    def _count_trace(self, name: str) -> None:
+        # ! Python code in a tf.function only runs while tracing
+        self.traces[name] += 1
+        if self.traces[name] > 1:
+            warnings.warn(f"CompiledTrainer: {name} traced {self.traces[name]} times, check the argument types and shapes", stacklevel=3)
+
+    def _step_function(self, images, labels):
+        self._count_trace("step")
+        with tf.GradientTape() as tape:
+            predictions = self.model(images, training=True)
+            loss = self.objective(labels, predictions)
+        gradients = tape.gradient(loss, self.model.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+        return loss, predictions
+
+    def _steps_function(self, iterator):
+        self._count_trace("steps")
+        steps = tf.constant(0)
+        # * autograph turns this loop into a single tf.while_loop over the iterator
+        for _ in tf.range(self.steps_per_call):
+            batch = iterator.get_next_as_optional()
+            if not batch.has_value():
+                break
+            images, labels = batch.get_value()
+            loss, predictions = self._step(images, labels)
+            # the metrics stay outside the XLA cluster
+            self.losses(loss)
+            self.accuracy(labels, predictions)
+            steps += 1
+        return steps
+
+    def train_epoch(self, dataset: tf.data.Dataset) -> int:
+        # returns the number of steps, the last call ends early when the iterator is exhausted
+        if not self._built:
+            self._build(dataset)
+        iterator = iter(dataset)
+        total = 0
+        while True:
+            steps = int(self._steps(iterator))
+            total += steps
+            if steps < self.steps_per_call:
+                return total
 
 
 @tf.function
@@ -69,6 +182,9 @@ if __name__ == "__main__":
     test_loss = tf.keras.metrics.Mean(name="test_loss")
     test_accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name="test_accuracy")
 
+    # * 50 steps per graph call, XLA for the step is optional
+    trainer = CompiledTrainer(model, loss_object, train_loss, train_accuracy, optimizer, steps_per_call=50, jit_compile=False)
+
     EPOCHS = 5
     for epoch in range(EPOCHS):
         train_loss.reset_states()
@@ -76,16 +192,7 @@ if __name__ == "__main__":
         test_loss.reset_states()
         test_accuracy.reset_states()
 
-        for images, labels in train_ds:
-            train_step(
-                model,
-                images,
-                labels,
-                loss_object,
-                train_loss,
-                train_accuracy,
-                optimizer,
-            )
+        trainer.train_epoch(train_ds)
 
         for test_images, test_labels in test_ds:
             test_step(